@@ -0,0 +1,310 @@
+"""
+Router and end-to-end benchmarks. Runs on the micropython unix port and on CPython:
+
+    $ micropython bench.py [name_prefix ...]
+    $ python3 bench.py [name_prefix ...]
+
+Every result is printed as one JSON object per line, so runs of different versions can be
+saved and compared. Heap figures are only reported on micropython, they are null on CPython.
+"""
+
+import asyncio
+import gc
+import json
+import sys
+
+from usniffs import Router, AwaitableReturns, Sniffs
+from usniffs.utils import ticks_us, ticks_diff
+
+
+IMPLEMENTATION = sys.implementation.name
+MEM_ALLOC = getattr(gc, "mem_alloc", None)
+MEM_FREE = getattr(gc, "mem_free", None)
+
+N_MESSAGES = 1000
+N_SOAK_MESSAGES = 20000
+
+
+async def _handler():
+    pass
+
+
+async def _handler__message(message):
+    pass
+
+
+def _sync_handler__message(message):
+    pass
+
+
+def _percentile(sorted_values: list, fraction: float) -> int:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def _report(name: str, params: dict, **results) -> None:
+    record = {"name": name, "implementation": IMPLEMENTATION, "params": params}
+    record.update(results)
+    print(json.dumps(record))
+
+
+def _mem_alloc():
+    return MEM_ALLOC() if MEM_ALLOC else None
+
+
+async def _measure(router: Router, topics: list, n_messages: int) -> dict:
+    """Route `n_messages` messages, cycling through `topics`, and time each one."""
+    latencies = [0] * n_messages
+    n_topics = len(topics)
+    for n in range(10):  # warm up
+        await router.route(topics[n % n_topics], "1")
+
+    gc.collect()
+    before = _mem_alloc()
+    start = ticks_us()
+    for n in range(n_messages):
+        message_start = ticks_us()
+        await router.route(topics[n % n_topics], "1")
+        latencies[n] = ticks_diff(ticks_us(), message_start)
+    elapsed = ticks_diff(ticks_us(), start)
+    after = _mem_alloc()
+
+    latencies.sort()
+    return {
+        "msgs_per_sec": n_messages * 1000000 // max(elapsed, 1),
+        "p50_us": _percentile(latencies, 0.5),
+        "p90_us": _percentile(latencies, 0.9),
+        "p99_us": _percentile(latencies, 0.99),
+        "max_us": latencies[-1],
+        "bytes_per_msg": None if before is None else max(0, after - before) // n_messages,
+    }
+
+
+async def bench_route_count():
+    for n_routes in (1, 10, 100, 500):
+        router = Router(AwaitableReturns())
+        for n in range(n_routes):
+            router.register(f"sensors/sensor_{n}/<reading>", _handler)
+        topics = [f"sensors/sensor_{n}/temperature" for n in range(0, n_routes, max(1, n_routes // 10))]
+        _report("route_count", {"routes": n_routes}, **(await _measure(router, topics, N_MESSAGES)))
+
+
+async def bench_topic_depth():
+    for depth in (2, 4, 8):
+        router = Router(AwaitableReturns())
+        levels = [f"level_{n}" for n in range(depth - 1)]
+        router.register("/".join(levels + ["<reading>"]), _handler__message)
+        topics = ["/".join(levels + ["temperature"])]
+        _report("topic_depth", {"depth": depth}, **(await _measure(router, topics, N_MESSAGES)))
+
+
+async def bench_option_set_size():
+    for n_options in (2, 8, 32):
+        router = Router(AwaitableReturns())
+        options = ",".join(f"room_{n}" for n in range(n_options))
+        router.register(f"home/<room>:{{{options}}}/temperature", _handler__message)
+        topics = [f"home/room_{n}/temperature" for n in range(n_options)]
+        _report("option_set_size", {"options": n_options}, **(await _measure(router, topics, N_MESSAGES)))
+
+
+async def bench_wildcard_density():
+    n_routes = 100
+    for percent in (0, 50, 100):
+        router = Router(AwaitableReturns())
+        topics = []
+        for n in range(n_routes):
+            if n * 100 < percent * n_routes:
+                router.register(f"devices/device_{n}/+/<reading>", _handler)
+            else:
+                router.register(f"devices/device_{n}/state/temperature", _handler)
+            topics.append(f"devices/device_{n}/state/temperature")
+        _report(
+            "wildcard_density",
+            {"routes": n_routes, "wildcard_percent": percent},
+            **(await _measure(router, topics, N_MESSAGES)),
+        )
+
+
+async def bench_soak():
+    router = Router(AwaitableReturns())
+    for n in range(50):
+        router.register(f"sensors/<sensor>:{{sensor_{n}}}/<reading>", _handler__message)
+    topics = [f"sensors/sensor_{n}/temperature" for n in range(50)]
+    gc.collect()
+    free_before = MEM_FREE() if MEM_FREE else None
+    results = await _measure(router, topics, N_SOAK_MESSAGES)
+    gc.collect()
+    free_after = MEM_FREE() if MEM_FREE else None
+    _report(
+        "soak",
+        {"routes": 50, "messages": N_SOAK_MESSAGES},
+        mem_free_before=free_before,
+        mem_free_after=free_after,
+        **results,
+    )
+
+
+async def bench_end_to_end():
+    """Messages through Sniffs: the mqtt_as queue stand-in, decoding and the router."""
+    sniffs = Sniffs()
+    for n in range(50):
+        sniffs.route(f"sensors/sensor_{n}/<reading>")(_handler__message)
+    topics = [f"sensors/sensor_{n}/temperature".encode() for n in range(50)]
+    n_topics = len(topics)
+    gc.collect()
+    start = ticks_us()
+    for n in range(N_MESSAGES):
+        await sniffs._handle(topics[n % n_topics], b"21.5", False)
+    elapsed = ticks_diff(ticks_us(), start)
+    _report("end_to_end", {"routes": 50}, msgs_per_sec=N_MESSAGES * 1000000 // max(elapsed, 1))
+
+
+async def bench_sync_handlers():
+    """The same routes with async and with plain handlers."""
+    for kind, handler in (("async", _handler__message), ("sync", _sync_handler__message)):
+        router = Router(AwaitableReturns())
+        for n in range(10):
+            router.register(f"sensors/sensor_{n}/<reading>", handler)
+        topics = [f"sensors/sensor_{n}/temperature" for n in range(10)]
+        _report("sync_handlers", {"handler": kind}, **(await _measure(router, topics, N_MESSAGES)))
+
+
+async def _power(message):
+    return message
+
+
+def _total_power(batch):
+    return sum(batch.payloads)
+
+
+async def bench_batch():
+    """
+    The same numeric route delivered one message at a time, and in windows of growing size.
+    Matching costs the same either way, so the sizes take turns and the best of several runs
+    of each is kept, to make the difference in delivery cost stand out from the noise.
+    """
+    topics = [f"meters/meter_{n}/power" for n in range(10)]
+    sizes = (1, 8, 64)
+    routers = []
+    for size in sizes:
+        router = Router(AwaitableReturns(), metrics=True)  # each handler call is timed and counted
+        if size == 1:
+            router.register("meters/+/power", _power, decoder="float")
+        else:
+            router.register("meters/+/power", _total_power, decoder="float", batch=size)
+        routers.append(router)
+    best = [None] * len(sizes)
+    for _ in range(10):
+        for n_size in range(len(sizes)):
+            router = routers[n_size]
+            start = ticks_us()
+            for n in range(N_MESSAGES):
+                await router.route(topics[n % 10], "1")
+            elapsed = ticks_diff(ticks_us(), start)
+            if best[n_size] is None or elapsed < best[n_size]:
+                best[n_size] = elapsed
+    for n_size in range(len(sizes)):
+        _report(
+            "batch",
+            {"batch": sizes[n_size]},
+            ns_per_msg=best[n_size] * 1000 // N_MESSAGES,
+            msgs_per_sec=N_MESSAGES * 1000000 // max(best[n_size], 1),
+        )
+
+
+def _cpu_bound(message):
+    total = 0
+    for n in range(200):
+        total += n * n
+    return total
+
+
+async def bench_worker():
+    """A CPU bound plain handler run inline on the loop, and on the worker thread."""
+    try:
+        from usniffs.worker import Worker
+    except ImportError:  # port without _thread
+        return
+    for kind in ("inline", "worker"):
+        awaitable_returns = AwaitableReturns()
+        router = Router(awaitable_returns)
+        router.register("work", _cpu_bound, threaded=True)
+        results = awaitable_returns.add_awaitable_route("work").subscribe(N_MESSAGES)
+        if kind == "worker":
+            router.worker = Worker(router, 16, poll_ms=1)
+            router.worker.start()
+        start = ticks_us()
+        for n in range(N_MESSAGES):
+            await router.route("work", "1")
+        while len(results) < N_MESSAGES:
+            await asyncio.sleep(0)
+        elapsed = ticks_diff(ticks_us(), start)
+        if router.worker:
+            router.worker.stop()
+        _report("worker", {"mode": kind}, msgs_per_sec=N_MESSAGES * 1000000 // max(elapsed, 1))
+
+
+def _heap_used():
+    """Heap in use: gc.mem_alloc on micropython, tracemalloc's current size on CPython."""
+    gc.collect()
+    if MEM_ALLOC:
+        return MEM_ALLOC()
+    import tracemalloc
+
+    return tracemalloc.get_traced_memory()[0]
+
+
+async def bench_memory_per_route():
+    tracemalloc = None
+    if not MEM_ALLOC:
+        import tracemalloc
+
+        tracemalloc.start()
+    n_routes = 200
+    for kind, template in (
+        ("literal", "home/room_{n}/temperature"),
+        ("placeholder", "home/room_{n}/<sensor>"),
+        ("options", "home/<room>:{{room_{n},hall}}/<sensor>"),
+    ):
+        sniffs = Sniffs()
+        before = _heap_used()
+        for n in range(n_routes):
+            sniffs.route(template.format(n=n))(_handler)
+        after = _heap_used()
+        _report("memory_per_route", {"routes": n_routes, "kind": kind}, bytes_per_route=(after - before) // n_routes)
+    if tracemalloc:
+        tracemalloc.stop()
+
+
+async def bench_topic_paths():
+    for n_options in (4, 8, 16):
+        router = Router(AwaitableReturns(), subscription_limit=None)
+        options = ",".join(f"o{n}" for n in range(n_options))
+        start = ticks_us()
+        router.register(f"<a>:{{{options}}}/<b>:{{{options}}}/<c>:{{{options}}}", _handler)
+        paths = router.get_topic_paths()
+        elapsed = ticks_diff(ticks_us(), start)
+        _report("topic_paths", {"options": n_options}, paths=len(paths), us=elapsed)
+
+
+BENCHMARKS = (
+    ("route_count", bench_route_count),
+    ("topic_depth", bench_topic_depth),
+    ("option_set_size", bench_option_set_size),
+    ("wildcard_density", bench_wildcard_density),
+    ("soak", bench_soak),
+    ("end_to_end", bench_end_to_end),
+    ("sync_handlers", bench_sync_handlers),
+    ("worker", bench_worker),
+    ("batch", bench_batch),
+    ("memory_per_route", bench_memory_per_route),
+    ("topic_paths", bench_topic_paths),
+)
+
+
+async def main(prefixes: list):
+    for name, benchmark in BENCHMARKS:
+        if not prefixes or any(name.startswith(prefix) for prefix in prefixes):
+            await benchmark()
+
+
+asyncio.run(main(sys.argv[1:]))
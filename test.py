@@ -4,9 +4,19 @@ look at the repo layout in the future.
 """
 
 import asyncio
+import gc
+import json
 import unittest
-from usniffs import Router, Sniffs, AwaitableReturns
-from usniffs.utils import arg_names
+from usniffs import Router, Sniffs, AwaitableReturns, Dispatcher
+from usniffs import MessageBuffer, BLOCK, DROP_OLDEST, DROP_NEWEST, KEEP_LATEST
+from usniffs import STR, BYTES, MEMORYVIEW, register_decoder, SHED, DEMOTE
+from usniffs import router as router_module
+from usniffs.cache import ClockCache
+from usniffs.dedup import DuplicateWindow
+from usniffs.compiler import render
+from usniffs.subscriptions import covers, minimise, split_share
+from usniffs.utils import arg_names, is_async, ticks_ms, ticks_diff
+from usniffs.worker import Worker
 
 _updated = False
 _updated2 = False
@@ -53,6 +63,38 @@ async def _handler__topic__message__room__sensor(topic, message, room, sensor):
     _update_dict["sensor"] = sensor
 
 
+async def _handler__topic__message__room__sensor_wildcard(sensor, topic, message):
+    global _updated
+    _updated = True
+    _update_dict["sensor"] = sensor
+    _update_dict["topic"] = topic
+
+
+async def _handler__message(message):
+    return message
+
+
+async def _handler__reading(reading):
+    return reading
+
+
+async def _handler__room(room):
+    return room
+
+
+class _Colliding:
+    """Payload whose hash collides with every other one, as short MicroPython hashes can."""
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __hash__(self):
+        return 1
+
+    def __len__(self):
+        return len(self.payload)
+
+
 class TestRouter(unittest.TestCase):
     def setUp(self):
         global _updated
@@ -135,6 +177,157 @@ class TestRouter(unittest.TestCase):
         for path in paths:
             assert path in expected_paths, f"{path} not in {expected_paths}"
 
+    def test_route_paths_are_deduplicated(self):
+        self.router.register("home/<room>/temperature", _handler)
+        self.router.register("home/+/temperature", _handler2)
+        self.router.register("home/<room>:{kitchen,hall}/temperature", _handler)
+        self.router.register("home/kitchen/humidity", _handler)
+        paths = self.router.get_topic_paths()
+        self.assertEqual(paths, ["home/+/temperature", "home/kitchen/humidity"])
+
+    def test_route_paths_collapse_large_option_sets(self):
+        async def run_test():
+            options = ",".join(f"o{n}" for n in range(10))
+            self.router.register(
+                f"<a>:{{{options}}}/<b>:{{{options}}}/<c>:{{x,y}}", _handler
+            )
+            paths = self.router.get_topic_paths()
+            self.assertEqual(len(paths), 20)  # 10 * 10 * 2 = 200 is over the limit of 32
+            self.assertIn("+/o1/x", paths)
+            self.assertEqual(await self.router.route("other/o2/x", ""), ())  # filtered by the router
+            self.assertFalse(_updated)
+            await self.router.route("o1/o2/x", "")
+            self.assertTrue(_updated)
+
+        asyncio.run(run_test())
+
+    def test_covers(self):
+        self.assertTrue(covers("a/+/c", "a/b/c"))
+        self.assertTrue(covers("a/#", "a/b/c"))
+        self.assertTrue(covers("a/#", "a"))
+        self.assertTrue(covers("+/+", "+/b"))
+        self.assertFalse(covers("a/b/c", "a/+/c"))
+        self.assertFalse(covers("a/+", "a/b/c"))
+        self.assertFalse(covers("a/+/#", "a/#"))
+        self.assertEqual(minimise(["a/b", "a/b", "a/+", "c"]), ["a/+", "c"])
+        self.assertTrue(covers("$share/g/a/#", "$share/g/a/b"))
+        self.assertFalse(covers("a/#", "$share/g/a/b"))
+        self.assertFalse(covers("$share/g/a/#", "a/b"))
+        self.assertFalse(covers("$share/g/a/#", "$share/h/a/b"))
+        self.assertEqual(split_share("$share/g/a/+"), ("g", "a/+"))
+
+    def test_shared_route(self):
+        async def run_test():
+            self.router.register("jobs/<reading>", _handler__reading, share="workers")
+            self.assertEqual(self.router.get_topic_paths(), ["$share/workers/jobs/+"])
+            self.assertEqual(await self.router.route(b"jobs/1", b""), ("1",))
+            self.assertEqual(await self.router.route(b"$share/workers/jobs/2", b""), ("2",))
+
+        asyncio.run(run_test())
+
+    def test_unregister(self):
+        async def run_test():
+            first = self.router.register("home/<room>/temperature", _handler)
+            second = self.router.register("home/+/temperature", _handler2)
+            literal = self.router.register("home/kitchen/temperature", _handler2)
+            self.assertEqual(self.router.unregister(first), [])  # filter still used by second
+            self.assertEqual(self.router.unregister(literal), ["home/kitchen/temperature"])
+            await self.router.route("home/kitchen/temperature", "")
+            self.assertFalse(_updated)
+            self.assertTrue(_updated2)
+            self.assertEqual(self.router.unregister(second), ["home/+/temperature"])
+            self.assertEqual(self.router.get_topic_paths(), [])
+            self.assertTrue(self.router._trie._root.is_empty())
+
+        asyncio.run(run_test())
+
+    def test_route_removing_itself_while_routing(self):
+        async def run_test():
+            def once():
+                self.router.unregister(one_shot)
+
+            one_shot = self.router.register("door/bell", once)
+            self.router.register("door/bell", _handler)
+            self.assertEqual(len(await self.router.route("door/bell", "")), 2)
+            self.assertEqual(len(await self.router.route("door/bell", "")), 1)
+
+        asyncio.run(run_test())
+
+    def test_subscription_changes(self):
+        router = self.router
+        everything = router.register("#", _handler)
+        router.register("a/b", _handler)
+        any_a = router.register("a/+", _handler)
+        subscribed = set(router.get_topic_paths())
+        self.assertEqual(subscribed, {"#"})
+
+        changes = router.subscription_changes(subscribed, released=router.unregister(everything))
+        self.assertEqual(changes, (["a/+"], ["#"]))  # a/+ still covers a/b
+        changes = router.subscription_changes(subscribed, released=router.unregister(any_a))
+        self.assertEqual(changes, (["a/b"], ["a/+"]))
+        plan = router.register("a/#", _handler)
+        changes = router.subscription_changes(subscribed, added=router.exclusive_filters(plan))
+        self.assertEqual((changes, subscribed), ((["a/#"], ["a/b"]), {"a/#"}))
+
+    def test_match_cache(self):
+        async def run_test():
+            router = Router(AwaitableReturns(), match_cache_size=2)
+            router.register("home/<room>/temperature", _handler)
+            await router.route("home/kitchen/temperature", "")
+            await router.route("home/kitchen/temperature", "")
+            self.assertEqual((router.match_cache.misses, router.match_cache.hits), (1, 1))
+
+            router.register("home/kitchen/temperature", _handler2)  # invalidates the cache
+            output = await router.route("home/kitchen/temperature", "")
+            self.assertEqual(len(output), 2)
+            self.assertEqual(router.match_cache.misses, 2)
+
+        asyncio.run(run_test())
+
+    def test_clock_cache_eviction(self):
+        cache = ClockCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.put("c", 3)  # every entry was referenced, so the sweep evicts the oldest
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.get("c"), 3)
+        cache.put("d", 4)  # "c" was used since the last sweep, "b" was not
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual((cache.get("c"), cache.get("d")), (3, 4))
+        self.assertEqual((len(cache), cache.evictions), (2, 2))
+
+    def test_route_plans_only_store_changed_options(self):
+        plan = self.router.register("a/<b>", _handler)
+        urgent = self.router.register("c/<b>", _handler, priority=1, dedup=False)
+        defaults = ("payload", "decoder", "dedup", "priority", "timeout_ms", "is_async", "batcher")
+        for name in defaults:
+            self.assertEqual(getattr(plan, name), getattr(router_module.RoutePlan, name))
+        self.assertEqual((urgent.priority, urgent.dedup), (1, False))
+        self.assertEqual((router_module.RoutePlan.priority, router_module.RoutePlan.dedup), (0, True))
+
+    def test_metrics(self):
+        async def run_test():
+            router = Router(AwaitableReturns(), metrics=True)
+
+            async def failing():
+                raise ValueError("failed")
+
+            router.register("home/<room>/temperature", _handler)
+            router.register("home/kitchen/temperature", failing)
+            await router.route("home/hall/temperature", "")
+            await router.route("home/hall/humidity", "")
+            with self.assertRaises(ValueError):
+                await router.route("home/kitchen/temperature", "")
+
+            stats = router.stats()
+            self.assertEqual(router.unmatched, 1)
+            self.assertEqual(stats[0]["route"], "home/<room>/temperature")
+            self.assertEqual((stats[0]["matches"], stats[0]["calls"], stats[0]["errors"]), (2, 2, 0))
+            self.assertEqual((stats[1]["matches"], stats[1]["calls"], stats[1]["errors"]), (1, 1, 1))
+            self.assertTrue(stats[0]["max_us"] <= stats[0]["total_us"])
+
+        asyncio.run(run_test())
+
     def test_route_does_not_match_partial_route(self):
         async def run_test():
             self.router.register("test/first", _handler)
@@ -174,6 +367,972 @@ class TestRouter(unittest.TestCase):
 
         asyncio.run(run_test())
 
+    def test_route_option_not_in_set(self):
+        async def run_test():
+            self.router.register(
+                "home/<any_variable>:{kitchen,living_room}/temperature",
+                _handler__any_variable__topic__message,
+            )
+            output = await self.router.route("home/bedroom/temperature", "20")
+            self.assertEqual(output, ())
+            self.assertFalse(_updated)
+
+        asyncio.run(run_test())
+
+    def test_route_overlapping_option_sets(self):
+        async def run_test():
+            kitchen = self.router.register("home/<room>:{kitchen,hall}/light", _handler__room)
+            bedroom = self.router.register("home/<room>:{bedroom,hall}/light", _handler__room)
+            self.assertEqual(await self.router.route("home/hall/light", ""), ("hall", "hall"))
+            self.assertEqual(await self.router.route("home/bedroom/light", ""), ("bedroom",))
+            self.assertEqual(len(self.router._trie._root.literals["home"].options["hall"]), 2)
+
+            self.router.unregister(kitchen)
+            self.assertEqual(await self.router.route("home/hall/light", ""), ("hall",))
+            self.assertEqual(await self.router.route("home/kitchen/light", ""), ())
+            self.router.unregister(bedroom)
+            self.assertTrue(self.router._trie._root.is_empty())
+
+        asyncio.run(run_test())
+
+    def test_route_does_not_match_level_prefix(self):
+        async def run_test():
+            self.router.register("home/<room>/temperature", _handler)
+            await self.router.route("home/kitchen/temperature_2", "")
+            self.assertFalse(_updated)
+
+        asyncio.run(run_test())
+
+    def test_route_many_routes(self):
+        async def run_test():
+            for n in range(100):
+                self.router.register(f"sensors/sensor_{n}/<reading>", _handler)
+            self.router.register(
+                "sensors/<sensor>/temperature", _handler__topic__message__room__sensor_wildcard
+            )
+            await self.router.route("sensors/sensor_42/temperature", "12")
+            self.assertTrue(_updated)
+            self.assertEqual(_update_dict["sensor"], "sensor_42")
+
+        asyncio.run(run_test())
+
+    def test_route_literal_and_placeholder_routes(self):
+        async def run_test():
+            self.router.register("home/kitchen/temperature", _handler)
+            self.router.register("home/<sensor>/temperature", _handler__topic__message__room__sensor_wildcard)
+            output = await self.router.route("home/kitchen/temperature", "20")
+            self.assertEqual(len(output), 2)
+            self.assertTrue(_updated)
+            self.assertEqual(_update_dict["sensor"], "kitchen")
+
+        asyncio.run(run_test())
+
+    def test_route_tail(self):
+        async def run_test():
+            async def rest_handler(device, rest):
+                return device, rest
+
+            self.router.register("devices/<device>/<rest...>", rest_handler)
+            self.router.register("devices/#", _handler)
+            self.assertEqual(self.router.get_topic_paths(), ["devices/#"])
+            output = await self.router.route("devices/d1/state/temperature", "")
+            self.assertEqual(output, (("d1", "state/temperature"), None))
+            self.assertEqual(await self.router.route("devices/d1", ""), (("d1", ""), None))
+            self.assertEqual(await self.router.route("devices", ""), (None,))  # `#` matches the parent
+            self.assertEqual(await self.router.route("other/d1", ""), ())
+            with self.assertRaises(Exception):
+                self.router.register("devices/#/state", _handler)
+
+            for plan in list(self.router.routes):
+                self.router.unregister(plan)
+            self.assertTrue(self.router._trie._root.is_empty())
+            self.assertEqual(self.router._tails, 0)
+
+        asyncio.run(run_test())
+
+    def test_route_allocation_per_message(self):
+        if not hasattr(gc, "mem_alloc"):
+            self.skipTest("gc.mem_alloc is only available on micropython")
+
+        async def bytes_per_message(router, n):
+            for _ in range(10):  # warm up
+                await router.route("sensors/sensor_1/temperature", "20")
+            gc.collect()
+            gc.disable()
+            before = gc.mem_alloc()
+            for _ in range(n):
+                await router.route("sensors/sensor_1/temperature", "20")
+            allocated = gc.mem_alloc() - before
+            gc.enable()
+            return allocated // n
+
+        async def run_test():
+            small_router = Router(AwaitableReturns())
+            small_router.register("sensors/<sensor>/<reading>", _handler__reading)
+            large_router = Router(AwaitableReturns())
+            for n in range(200):
+                large_router.register(f"other/sensor_{n}/<reading>", _handler__reading)
+            large_router.register("sensors/<sensor>/<reading>", _handler__reading)
+
+            small = await bytes_per_message(small_router, 100)
+            large = await bytes_per_message(large_router, 100)
+            self.assertLess(small, 1024)
+            self.assertLess(abs(large - small), 64)  # independent of the number of routes
+
+        asyncio.run(run_test())
+
+    def test_route_payload_modes(self):
+        async def run_test():
+            received = {}
+
+            async def as_str(topic, message):
+                received["str"] = (topic, message)
+
+            async def as_str_again(message):
+                received["str_again"] = message
+
+            async def as_bytes(message):
+                received["bytes"] = message
+
+            async def as_memoryview(message):
+                received["memoryview"] = bytes(message)
+
+            self.router.register("sensor/<name>", as_str)
+            self.router.register("sensor/<name>", as_str_again, STR)
+            self.router.register("sensor/<name>", as_bytes, BYTES)
+            self.router.register("sensor/<name>", as_memoryview, MEMORYVIEW)
+            await self.router.route(b"sensor/one", b"\x01\x02")
+
+            self.assertEqual(received["str"], ("sensor/one", "\x01\x02"))
+            self.assertTrue(received["str"][1] is received["str_again"])  # decoded once
+            self.assertEqual(received["bytes"], b"\x01\x02")
+            self.assertEqual(received["memoryview"], b"\x01\x02")
+
+        asyncio.run(run_test())
+
+    def test_route_topic_is_cached(self):
+        async def run_test():
+            topics = []
+
+            async def handler(topic):
+                topics.append(topic)
+
+            self.router.register("sensor/<name>", handler)
+            await self.router.route(b"sensor/one", b"")
+            await self.router.route(b"sensor/one", b"")
+            self.assertEqual(topics[0], "sensor/one")
+            self.assertTrue(topics[0] is topics[1])
+
+        asyncio.run(run_test())
+
+    def test_route_decoders(self):
+        async def run_test():
+            received = {}
+
+            async def json_one(message):
+                received["json_one"] = message
+
+            async def json_two(message):
+                received["json_two"] = message
+
+            async def as_int(message):
+                received["int"] = message
+
+            async def as_struct(message):
+                received["struct"] = message
+
+            self.router.register("sensor/json", json_one, decoder="json")
+            self.router.register("sensor/json", json_two, decoder="json")
+            self.router.register("sensor/int", as_int, decoder=int)
+            self.router.register("sensor/struct", as_struct, decoder="struct:<hB")
+            await self.router.route(b"sensor/json", b'{"value": 1}')
+            await self.router.route(b"sensor/int", b"42")
+            await self.router.route(b"sensor/struct", b"\xff\xff\x02")
+
+            self.assertEqual(received["json_one"], {"value": 1})
+            self.assertTrue(received["json_one"] is received["json_two"])  # decoded once
+            self.assertEqual(received["int"], 42)
+            self.assertEqual(received["struct"], (-1, 2))
+
+        asyncio.run(run_test())
+
+    def test_route_decoder_failure_is_counted(self):
+        async def run_test():
+            def parse_celsius(payload):
+                return float(payload[:-1]) if payload.endswith("C") else float("invalid")
+
+            register_decoder("celsius", parse_celsius)
+            plan = self.router.register("sensor/temperature", _handler__message, decoder="celsius")
+            output = await self.router.route(b"sensor/temperature", b"not a number")
+            self.assertEqual(output, ())
+            self.assertEqual(plan.decode_errors, 1)
+            output = await self.router.route(b"sensor/temperature", b"21.5C")
+            self.assertEqual(output, (21.5,))
+
+        asyncio.run(run_test())
+
+    def test_route_decoder_shared_across_payload_modes(self):
+        async def run_test():
+            def kind(payload):
+                return type(payload).__name__
+
+            self.router.register("sensor/raw", _handler__message, payload=BYTES, decoder=kind)
+            self.router.register("sensor/+", _handler__message, payload=STR, decoder=kind)
+            self.assertEqual(await self.router.route(b"sensor/raw", b"1"), ("bytes", "str"))
+
+        asyncio.run(run_test())
+
+    def test_duplicates_are_skipped_by_routes_that_opt_in(self):
+        async def run_test():
+            router = Router(AwaitableReturns(), dedup_size=4, dedup_window_ms=50)
+            router.register("valve/<valve>/set", _handler__message)
+            router.register("valve/+/set", _handler2, dedup=False)
+            self.assertEqual(len(await router.route(b"valve/1/set", b"open")), 2)
+            self.assertEqual(await router.route(b"valve/1/set", b"open"), (None,))  # redelivered
+            self.assertEqual(len(await router.route(b"valve/1/set", b"close")), 2)
+            self.assertEqual(router.duplicates.duplicates, 1)
+
+            await asyncio.sleep(0.06)  # outside the window, the same command again
+            self.assertEqual(len(await router.route(b"valve/1/set", b"open")), 2)
+
+        asyncio.run(run_test())
+
+    def test_duplicate_window_compares_topic_and_length(self):
+        window = DuplicateWindow(4, 1000)
+        self.assertFalse(window.seen("a", _Colliding(b"on")))
+        self.assertFalse(window.seen("b", _Colliding(b"on")))  # same hash, other topic
+        self.assertFalse(window.seen("a", _Colliding(b"off")))  # same hash, other length
+        self.assertTrue(window.seen("a", _Colliding(b"on")))
+
+    def test_slow_routes_time_out_and_are_shed(self):
+        async def run_test():
+            router = Router(AwaitableReturns(), slow_after=2, slow_ms=50, slow_policy=SHED)
+
+            async def hangs(message):
+                if message == "hang":
+                    await asyncio.sleep(10)
+                return message
+
+            plan = router.register("sensor", hangs, timeout_ms=10)
+            self.assertEqual(await router.route("sensor", "hang"), (None,))
+            self.assertEqual(await router.route("sensor", "ok"), ("ok",))  # resets the strikes
+            self.assertEqual(await router.route("sensor", "hang"), (None,))
+            self.assertEqual(await router.route("sensor", "hang"), (None,))
+            self.assertEqual(await router.route("sensor", "ok"), ())  # shed
+            self.assertEqual((plan.timeouts, router.shed), (3, 1))
+            self.assertEqual(router.stats()[0]["timeouts"], 3)
+
+            await asyncio.sleep(0.06)
+            self.assertEqual(await router.route("sensor", "ok"), ("ok",))
+
+        asyncio.run(run_test())
+
+    def test_slow_routes_are_demoted(self):
+        async def run_test():
+            router = Router(AwaitableReturns(), slow_after=1, slow_ms=50, slow_policy=DEMOTE)
+            dispatcher = Dispatcher(router, 1, priorities=2)
+
+            async def hangs():
+                await asyncio.sleep(10)
+
+            plan = router.register("sensor", hangs, priority=1, timeout_ms=10)
+            await dispatcher.dispatch("sensor", "")
+            await dispatcher.wait_idle()
+            self.assertEqual(plan.priority, 0)
+            await dispatcher.dispatch("sensor", "")
+            await dispatcher.wait_idle()
+            self.assertEqual([stats["started"] for stats in dispatcher.stats()], [1, 1])
+
+            await asyncio.sleep(0.06)
+            router.receive("sensor", "")  # the penalty is lifted when the route next matches
+            self.assertEqual(plan.priority, 1)
+
+            with self.assertRaises(Exception):
+                Dispatcher(Router(AwaitableReturns(), slow_policy=DEMOTE), 1)
+            with self.assertRaises(Exception):
+                Sniffs(slow_policy=DEMOTE)
+            Sniffs(concurrency=2, priorities=2, slow_policy=DEMOTE)
+
+            # Without a dispatcher there is no class to demote to, so the route is shed.
+            router = Router(AwaitableReturns(), slow_after=1, slow_ms=50, slow_policy=DEMOTE)
+            plan = router.register("sensor", hangs, priority=1, timeout_ms=10)
+            self.assertEqual(await router.route("sensor", ""), (None,))
+            self.assertEqual(await router.route("sensor", ""), ())
+            self.assertEqual((router.shed, plan.priority), (1, 1))
+
+        asyncio.run(run_test())
+
+    def test_retained_replays_are_suppressed(self):
+        async def run_test():
+            router = Router(AwaitableReturns(), retained_cache_size=2)
+            router.register("rooms/<room>/state", _handler__message)
+            self.assertEqual(await router.route(b"rooms/hall/state", b"on", True), ("on",))
+            self.assertEqual(await router.route(b"rooms/hall/state", b"on", True), ())  # replay
+            self.assertEqual(await router.route(b"rooms/hall/state", b"on"), ("on",))  # live
+            self.assertEqual(await router.route(b"rooms/hall/state", b"off", True), ("off",))
+            self.assertEqual(router.suppressed, 1)
+
+            for room in (b"a", b"b", b"c"):  # evicts hall, the cache holds two topics
+                await router.route(b"rooms/" + room + b"/state", b"on", True)
+            self.assertEqual(await router.route(b"rooms/hall/state", b"off", True), ("off",))
+            self.assertEqual(len(router.retained_cache), 2)
+
+            # A changed payload is delivered even when its hash collides with the last one.
+            self.assertFalse(router.suppress("rooms/x/state", _Colliding(b"on"), True))
+            self.assertFalse(router.suppress("rooms/x/state", _Colliding(b"off"), True))
+            self.assertTrue(router.suppress("rooms/x/state", _Colliding(b"off"), True))
+
+        asyncio.run(run_test())
+
+    def test_batched_routes(self):
+        async def run_test():
+            router = Router(AwaitableReturns())
+            batches = []
+
+            def total(batch):
+                batches.append([(topic, captures) for topic, captures, _ in batch])
+                return sum(batch.payloads)
+
+            plan = router.register("sensors/<sensor>/power", total, decoder="float", batch=3)
+            self.assertEqual(await router.route("sensors/a/power", "1.5"), (None,))
+            self.assertEqual(await router.route("sensors/b/power", "2"), (None,))
+            self.assertEqual(await router.route("sensors/a/power", "0.5"), (4.0,))
+            self.assertEqual(batches[0][2], ("sensors/a/power", ("a",)))
+            self.assertEqual(len(plan.batcher.batch), 0)
+
+            def count(batch):
+                return len(batch)
+
+            router.register("meters/<meter...>", count, batch_ms=20)
+            window_returns = router._awaitable_returns.add_awaitable_route("meters/<meter...>")
+            await router.route("meters/m1", "")
+            await router.route("meters/m2/phase", "")
+            self.assertEqual(await asyncio.wait_for(window_returns.fetch_next_result(), 1), 2)
+            self.assertEqual(plan.batcher.typecode, "f")
+
+            counts = router.register("counters/<counter>", total, decoder="int", batch=2)
+            self.assertEqual(await router.route("counters/a", str(2**40)), ())  # does not fit
+            self.assertEqual(await router.route("counters/a", str(2**31)), ())
+            self.assertEqual(counts.decode_errors, 2)
+            self.assertEqual(await router.route("counters/a", str(-2**31)), (None,))
+            self.assertEqual(await router.route("counters/a", str(2**31 - 1)), (-1,))
+
+            with self.assertRaises(Exception):
+                router.register("sensors/<sensor>/state", _handler__message, batch=2)
+
+        asyncio.run(run_test())
+
+
+
+class TestDispatcher(unittest.TestCase):
+    def test_routes_run_in_parallel_and_keep_order(self):
+        async def run_test():
+            awaitable_returns = AwaitableReturns()
+            router = Router(awaitable_returns)
+            dispatcher = Dispatcher(router, 4)
+            calls = []
+
+            async def slow(message):
+                await asyncio.sleep(0.05)
+                calls.append(("slow", message))
+                return message
+
+            async def fast(message):
+                calls.append(("fast", message))
+
+            router.register("slow", slow)
+            router.register("fast", fast)
+            for n in range(2):
+                await dispatcher.dispatch("slow", str(n))
+                await dispatcher.dispatch("fast", str(n))
+            await dispatcher.wait_idle()
+
+            self.assertEqual(calls[:2], [("fast", "0"), ("fast", "1")])  # not stuck behind slow
+            self.assertEqual(calls[2:], [("slow", "0"), ("slow", "1")])  # per route order is kept
+
+        asyncio.run(run_test())
+
+    def _run_priorities(self, weights):
+        async def run_test():
+            router = Router(AwaitableReturns())
+            dispatcher = Dispatcher(router, 1, priorities=2, weights=weights, backlog=8)
+            calls = []
+
+            async def handler(topic):
+                await asyncio.sleep(0.01)
+                calls.append(topic)
+
+            for topic in ("a", "b", "c", "d"):
+                router.register(topic, handler)
+            for topic in ("e", "f"):
+                router.register(topic, handler, priority=1)
+            for topic in ("a", "b", "c", "d", "e", "f"):
+                await dispatcher.dispatch(topic, "")
+            await dispatcher.wait_idle()
+
+            stats = dispatcher.stats()
+            self.assertEqual((stats[0]["started"], stats[1]["started"]), (4, 2))
+            self.assertLess(stats[1]["wait_max_us"], stats[0]["wait_max_us"])
+            return calls
+
+        return asyncio.run(run_test())
+
+    def test_strict_priority(self):
+        self.assertEqual(self._run_priorities(None), ["a", "e", "f", "b", "c", "d"])
+
+    def test_weighted_priority(self):
+        self.assertEqual(self._run_priorities((1, 1)), ["a", "e", "b", "f", "c", "d"])
+
+    def test_timed_batch_windows_keep_to_the_limit(self):
+        async def run_test():
+            router = Router(AwaitableReturns())
+            dispatcher = Dispatcher(router, 1, backlog=4)
+            running = [0, 0]  # current, max
+
+            async def slow(message):
+                running[0] += 1
+                running[1] = max(running)
+                await asyncio.sleep(0.03)
+                running[0] -= 1
+
+            async def total(batch):
+                await slow(len(batch))
+
+            router.register("slow", slow)
+            router.register("meters/<meter>", total, batch=8, batch_ms=10)
+            await dispatcher.dispatch("meters/a", "1")
+            await dispatcher.dispatch("slow", "")
+            await asyncio.sleep(0.02)  # the window times out while the slow route runs
+            await dispatcher.wait_idle()
+            self.assertEqual((dispatcher.stats()[0]["started"], running[1]), (2, 1))
+
+            # Without a dispatcher, windows of a route are still handled one at a time.
+            router = Router(AwaitableReturns())
+            running[1] = 0
+            router.register("meters/<meter>", total, batch=2, batch_ms=10)
+            await router.route("meters/a", "1")
+            await asyncio.sleep(0.015)  # the timed out window is being handled
+            await router.route("meters/a", "1")
+            await router.route("meters/a", "1")  # closes a window by count
+            self.assertEqual(running[1], 1)
+
+        asyncio.run(run_test())
+
+    def test_saturated_class_does_not_hold_back_urgent_messages(self):
+        async def run_test():
+            router = Router(AwaitableReturns())
+            dispatcher = Dispatcher(router, 3, priorities=2, backlog=2)
+            started = []
+
+            async def telemetry(message):
+                await asyncio.sleep(0.1)
+
+            async def urgent():
+                started.append(ticks_ms())
+
+            router.register("telemetry", telemetry)
+            router.register("urgent", urgent, priority=1)
+            start = ticks_ms()
+            for n in range(10):
+                await dispatcher.dispatch("telemetry", str(n))
+            await dispatcher.dispatch("urgent", "")
+            await asyncio.sleep(0.01)
+            self.assertEqual(len(started), 1)
+            self.assertLess(ticks_diff(started[0], start), 50)
+
+            stats = dispatcher.stats()
+            self.assertEqual((stats[0]["queued"], stats[0]["dropped"]), (2, 8))
+            await dispatcher.wait_idle()
+            with self.assertRaises(Exception):
+                Dispatcher(router, 3, priorities=2, overload=BLOCK)
+
+        asyncio.run(run_test())
+
+    def test_concurrency_limit(self):
+        async def run_test():
+            router = Router(AwaitableReturns())
+            dispatcher = Dispatcher(router, 2)
+            running = [0, 0]  # current, max
+
+            async def handler():
+                running[0] += 1
+                running[1] = max(running)
+                await asyncio.sleep(0.01)
+                running[0] -= 1
+
+            for n in range(5):
+                router.register(f"route/{n}", handler)
+            for n in range(5):
+                await dispatcher.dispatch(f"route/{n}", "")
+            await dispatcher.wait_idle()
+            self.assertEqual(running[1], 2)
+
+        asyncio.run(run_test())
+
+
+
+class TestWorker(unittest.TestCase):
+    def test_threaded_routes_run_on_the_worker(self):
+        async def run_test():
+            import _thread
+
+            awaitable_returns = AwaitableReturns()
+            router = Router(awaitable_returns, metrics=True)
+            router.worker = Worker(router, capacity=2, poll_ms=1)
+            loop_thread = _thread.get_ident()
+
+            def square(message):
+                return int(message) ** 2, _thread.get_ident() != loop_thread
+
+            router.register("square", square, threaded=True)
+            results = awaitable_returns.add_awaitable_route("square").subscribe(16)
+            router.worker.start()
+            for n in range(10):  # more than the ring holds, so submitting waits for the thread
+                self.assertEqual(await router.route("square", str(n)), (None,))
+            received = [await results.__anext__() for _ in range(10)]
+            router.worker.stop()
+
+            self.assertEqual(received, [(n * n, True) for n in range(10)])
+            self.assertEqual(router.stats()[0]["calls"], 10)
+            with self.assertRaises(Exception):
+                router.register("square", _handler, threaded=True)  # async handlers stay on the loop
+
+        asyncio.run(run_test())
+
+
+class TestAwaitableReturns(unittest.TestCase):
+    def test_stream_is_lossless_for_every_consumer(self):
+        async def run_test():
+            route = AwaitableReturns().add_awaitable_route("a/b")
+            first = route.subscribe()
+            second = route.subscribe()
+            route.trigger(1)
+            route.trigger(2)  # before either consumer has read
+            for consumer in (first, second):
+                self.assertEqual(await consumer.__anext__(), 1)
+                self.assertEqual(await consumer.__anext__(), 2)
+
+        asyncio.run(run_test())
+
+    def test_stream_async_for(self):
+        async def run_test():
+            route = AwaitableReturns().add_awaitable_route("a/b")
+            received = []
+
+            async def consume():
+                async with route.subscribe() as stream:
+                    async for value in stream:
+                        received.append(value)
+                        if len(received) == 3:
+                            break
+
+            for _ in range(100):
+                received = []
+                task = asyncio.create_task(consume())
+                await asyncio.sleep(0)
+                for n in range(3):
+                    route.trigger(n)
+                await task
+                self.assertEqual(received, [0, 1, 2])
+            self.assertEqual(route._consumers, [])  # every stream was closed on leaving the block
+
+            task = asyncio.create_task(consume())
+            await asyncio.sleep(0)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            self.assertEqual(route._consumers, [])
+
+        asyncio.run(run_test())
+
+    def test_stream_overflow_and_history(self):
+        async def run_test():
+            route = AwaitableReturns().add_awaitable_route("a/b", depth=2, history=2)
+            consumer = route.subscribe()
+            for n in range(5):
+                route.trigger(n)
+            self.assertEqual(consumer.overflows, 3)
+            self.assertEqual(route.overflows, 3)
+            self.assertEqual([await consumer.__anext__() for _ in range(2)], [3, 4])
+
+            late = route.subscribe(depth=4)  # starts with the last two results
+            route.trigger(5)
+            self.assertEqual([await late.__anext__() for _ in range(3)], [3, 4, 5])
+            late.close()
+            route.trigger(6)
+            self.assertEqual(len(late), 0)
+
+        asyncio.run(run_test())
+
+
+
+class TestMessageBuffer(unittest.TestCase):
+    def _fill(self, buffer, items):
+        for item in items:
+            buffer.put_nowait(item)
+
+    def _drain(self, buffer):
+        async def drain():
+            return [await buffer.get() for _ in range(len(buffer))]
+
+        return asyncio.run(drain())
+
+    def test_drop_oldest(self):
+        buffer = MessageBuffer(2, DROP_OLDEST)
+        self._fill(buffer, [("a", 1), ("b", 2), ("c", 3)])
+        self.assertEqual(buffer.dropped, 1)
+        self.assertEqual(self._drain(buffer), [("b", 2), ("c", 3)])
+
+    def test_drop_newest(self):
+        buffer = MessageBuffer(2, DROP_NEWEST)
+        self._fill(buffer, [("a", 1), ("b", 2), ("c", 3)])
+        self.assertEqual(buffer.dropped, 1)
+        self.assertEqual(self._drain(buffer), [("a", 1), ("b", 2)])
+
+    def test_keep_latest(self):
+        buffer = MessageBuffer(2, KEEP_LATEST)
+        self._fill(buffer, [("a", 1), ("b", 2), ("a", 3), ("c", 4), ("a", 5)])
+        self.assertEqual(buffer.dropped, 3)
+        self.assertEqual(self._drain(buffer), [("c", 4), ("a", 5)])
+        self._fill(buffer, [("b", 6), ("b", 7)])
+        self.assertEqual(self._drain(buffer), [("b", 7)])
+
+    def test_block(self):
+        async def run_test():
+            buffer = MessageBuffer(1, BLOCK)
+            await buffer.put(("a", 1))
+            task = asyncio.create_task(buffer.put(("b", 2)))
+            await asyncio.sleep(0)
+            self.assertEqual(len(buffer), 1)
+            self.assertEqual(await buffer.get(), ("a", 1))
+            await task
+            self.assertEqual(await buffer.get(), ("b", 2))
+            self.assertEqual(buffer.dropped, 0)
+
+        asyncio.run(run_test())
+
+
+
+class _FakeQueue:
+    """Stands in for the mqtt_as message queue."""
+
+    def __init__(self):
+        self._items = []
+        self._ready = asyncio.Event()
+
+    def put(self, topic, msg, retained=False):
+        self._items.append((topic, msg, retained))
+        self._ready.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._items:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._items.pop(0)
+
+
+class _FakeClient:
+    """Stands in for the mqtt_as client, with `rtt` seconds of delay on every broker round trip."""
+
+    def __init__(self, rtt=0.0):
+        self.rtt = rtt
+        self.up = asyncio.Event()
+        self.down = asyncio.Event()
+        self.queue = _FakeQueue()
+        self.subscribed = []
+        self.published = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def subscribe(self, topic, qos=0):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.rtt)
+        self.in_flight -= 1
+        self.subscribed.append(topic)
+
+    async def unsubscribe(self, topic):
+        await asyncio.sleep(self.rtt)
+        self.subscribed.remove(topic)
+
+    async def publish(self, topic, msg, retain=False, qos=0):
+        await asyncio.sleep(self.rtt)
+        self.published.append((topic, msg))
+
+
+class _SharedBroker:
+    """Stands in for a broker with shared subscriptions, taking turns between group members."""
+
+    def __init__(self, clients):
+        self.clients = clients
+        self._turns = {}  # dict[tuple[str, str], int] messages sent to each group and filter
+
+    def publish(self, topic, msg):
+        groups = {}
+        for client in self.clients:
+            for topic_filter in client.subscribed:
+                group, underlying = split_share(topic_filter)
+                if not covers(underlying, topic):
+                    continue
+                if group is None:
+                    client.queue.put(topic.encode(), msg)
+                else:
+                    groups.setdefault((group, underlying), []).append(client)
+        for key, members in groups.items():
+            turn = self._turns.get(key, 0)
+            self._turns[key] = turn + 1
+            members[turn % len(members)].queue.put(topic.encode(), msg)
+
+
+class TestSniffsClient(unittest.TestCase):
+    def setUp(self):
+        global _updated
+        global _updated2
+        _updated = False
+        _updated2 = False
+
+    def test_resubscribe_is_pipelined(self):
+        async def run_test():
+            connected = asyncio.Event()
+
+            async def on_connect():
+                connected.set()
+
+            client = _FakeClient(rtt=0.02)
+            new_sniffs = Sniffs(on_connect=on_connect, subscribe_in_flight=5)
+            for n in range(20):
+                new_sniffs.route(f"sensors/sensor_{n}")(_handler)
+            await new_sniffs.bind(client)
+            client.up.set()
+            await connected.wait()
+
+            self.assertEqual(len(client.subscribed), 20)
+            self.assertEqual(client.max_in_flight, 5)
+            self.assertLess(new_sniffs.reconnect_ms, 20 * 20 // 2)  # one at a time takes 400ms
+
+        asyncio.run(run_test())
+
+    def test_add_and_remove_routes_at_runtime(self):
+        async def run_test():
+            connected = asyncio.Event()
+
+            async def on_connect():
+                connected.set()
+
+            client = _FakeClient()
+            new_sniffs = Sniffs(on_connect=on_connect)
+            new_sniffs.route("rooms/<room>:{kitchen}/temperature")(_handler)
+            await new_sniffs.bind(client)
+            client.up.set()
+            await connected.wait()
+            self.assertEqual(client.subscribed, ["rooms/kitchen/temperature"])
+
+            hall = await new_sniffs.add_route("rooms/<room>:{hall,kitchen}/temperature", _handler2)
+            self.assertEqual(
+                client.subscribed, ["rooms/kitchen/temperature", "rooms/hall/temperature"]
+            )
+            await new_sniffs.router.route("rooms/hall/temperature", "")
+            self.assertTrue(_updated2)
+
+            await new_sniffs.remove_route(hall)
+            self.assertEqual(client.subscribed, ["rooms/kitchen/temperature"])  # still needed
+            self.assertEqual(await new_sniffs.router.route("rooms/hall/temperature", ""), ())
+            self.assertEqual(len(await new_sniffs.router.route("rooms/kitchen/temperature", "")), 1)
+
+        asyncio.run(run_test())
+
+    def test_removing_a_covering_route_subscribes_to_the_covered_filters(self):
+        async def run_test():
+            connected = asyncio.Event()
+
+            async def on_connect():
+                connected.set()
+
+            client = _FakeClient()
+            new_sniffs = Sniffs(on_connect=on_connect)
+            new_sniffs.route("a/b")(_handler)
+            await new_sniffs.bind(client)
+            any_b = await new_sniffs.add_route("a/+", _handler2)
+            client.up.set()
+            await connected.wait()
+            self.assertEqual(client.subscribed, ["a/+"])  # covers a/b
+
+            await new_sniffs.remove_route(any_b)
+            self.assertEqual(client.subscribed, ["a/b"])
+
+            any_b = await new_sniffs.add_route("a/+", _handler2)
+            self.assertEqual(client.subscribed, ["a/+"])
+
+        asyncio.run(run_test())
+
+
+    def test_metrics_are_published(self):
+        async def run_test():
+            client = _FakeClient()
+            new_sniffs = Sniffs(metrics_topic="device/metrics", metrics_interval=0.01)
+            new_sniffs.route("sensors/<sensor>")(_handler)
+            await new_sniffs.bind(client)
+            client.up.set()
+            client.queue.put(b"sensors/one", b"1")
+            client.queue.put(b"other", b"1")
+            await asyncio.sleep(0.05)
+
+            stats = new_sniffs.stats()
+            self.assertEqual((stats["received"], stats["unmatched"]), (2, 1))
+            self.assertEqual(stats["routes"][0]["calls"], 1)
+            topic, msg = client.published[-1]
+            self.assertEqual(topic, "device/metrics")
+            self.assertEqual(json.loads(msg)["received"], 2)
+
+        asyncio.run(run_test())
+
+    def test_shared_routes_split_messages_across_devices(self):
+        async def run_test():
+            clients = [_FakeClient() for _ in range(3)]
+            broker = _SharedBroker(clients)
+            handled = []
+
+            def handlers(device):
+                def job(job):
+                    handled.append((device, job))
+
+                def status(message):
+                    handled.append((device, message))
+
+                return job, status
+
+            for n, client in enumerate(clients):
+                device = Sniffs()
+                job, status = handlers(n)
+                device.route("jobs/<job>", share="workers")(job)
+                device.route("fleet/status")(status)
+                await device.bind(client)
+                client.up.set()
+            await asyncio.sleep(0.01)
+            self.assertEqual(clients[0].subscribed, ["$share/workers/jobs/+", "fleet/status"])
+
+            for n in range(30):
+                broker.publish(f"jobs/{n}", b"")
+            broker.publish("fleet/status", b"ping")
+            await asyncio.sleep(0.01)
+
+            for n in range(3):
+                jobs = [job for device, job in handled if device == n and job != "ping"]
+                self.assertEqual(len(jobs), 10)
+                self.assertIn((n, "ping"), handled)
+            self.assertEqual(len(set(job for _, job in handled)), 31)
+
+        asyncio.run(run_test())
+
+    def test_publish_is_queued_while_offline_and_coalesced(self):
+        async def run_test():
+            client = _FakeClient()
+            new_sniffs = Sniffs(outbox_size=2, outbox_policy=KEEP_LATEST)
+            await new_sniffs.bind(client)
+            self.assertTrue(new_sniffs.publish("a", "1"))
+            self.assertTrue(new_sniffs.publish("b", "1"))
+            self.assertTrue(new_sniffs.publish("a", "2"))  # replaces the queued "a"
+            self.assertTrue(new_sniffs.publish("c", "1"))  # full, drops the oldest ("a")
+            await asyncio.sleep(0.01)
+            self.assertEqual(client.published, [])
+
+            client.up.set()
+            await asyncio.sleep(0.01)
+            self.assertEqual(client.published, [("b", "1"), ("c", "1")])
+            stats = new_sniffs.stats()
+            self.assertEqual((stats["published"], stats["outbox_dropped"]), (2, 2))
+
+        asyncio.run(run_test())
+
+    def test_publish_rate(self):
+        async def run_test():
+            client = _FakeClient()
+            new_sniffs = Sniffs(publish_rate=50)
+            await new_sniffs.bind(client)
+            client.up.set()
+            await asyncio.sleep(0)
+            start = ticks_ms()
+            for n in range(5):
+                new_sniffs.publish("a", str(n))
+            while len(client.published) < 5:
+                await asyncio.sleep(0.005)
+            self.assertGreaterEqual(ticks_diff(ticks_ms(), start), 4 * 20)
+
+        asyncio.run(run_test())
+
+
+    def test_publish_failure_does_not_stop_the_writer(self):
+        async def run_test():
+            client = _FakeClient()
+            publish = client.publish
+
+            async def strict_publish(topic, msg, retain=False, qos=0):
+                if isinstance(msg, int):
+                    raise TypeError("object with buffer protocol required")
+                await publish(topic, msg, retain, qos)
+
+            client.publish = strict_publish
+            new_sniffs = Sniffs()
+            await new_sniffs.bind(client)
+            client.up.set()
+            new_sniffs.publish("t", 42)
+            new_sniffs.publish("t", "42")
+            new_sniffs.publish("u", "1")
+            await asyncio.sleep(0.01)
+            self.assertEqual(client.published, [("t", "42"), ("u", "1")])
+            self.assertEqual(len(new_sniffs.outbox), 0)
+
+        asyncio.run(run_test())
+
+
+class _CompiledRoutes:
+    def __init__(self, source):
+        namespace = {}
+        exec(source, namespace)
+        self.ROUTES = namespace["ROUTES"]
+        self.SUBSCRIPTIONS = namespace["SUBSCRIPTIONS"]
+
+
+class TestCompiler(unittest.TestCase):
+    def _register(self, new_sniffs):
+        new_sniffs.route("home/<room>:{kitchen,hall}/<sensor>")(_handler__topic__message__room__sensor)
+        new_sniffs.route("home/+/status")(_handler)
+
+    def test_compiled_routes(self):
+        async def run_test():
+            source_sniffs = Sniffs()
+            self._register(source_sniffs)
+            compiled = _CompiledRoutes(render(source_sniffs))
+
+            def no_runtime_compile(fun):
+                raise AssertionError("route was compiled at runtime")
+
+            runtime_arg_names = router_module.arg_names
+            router_module.arg_names = no_runtime_compile
+            try:
+                new_sniffs = Sniffs(compiled=compiled)
+                self._register(new_sniffs)
+            finally:
+                router_module.arg_names = runtime_arg_names
+
+            self.assertEqual(new_sniffs.router.get_topic_paths(), source_sniffs.router.get_topic_paths())
+            await new_sniffs.router.route("home/hall/temperature", "20")
+            self.assertEqual(_update_dict["room"], "hall")
+            self.assertEqual(_update_dict["sensor"], "temperature")
+            self.assertEqual(_update_dict["message"], "20")
+            self.assertEqual(await new_sniffs.router.route("home/bedroom/temperature", "20"), ())
+
+            new_sniffs.route("home/<room>/humidity")(_handler)  # not compiled, so compiled at runtime
+            self.assertIn("home/+/humidity", new_sniffs.router.get_topic_paths())
+
+        asyncio.run(run_test())
+
+
 
 sniffs = Sniffs()
 _topic = ""
@@ -287,6 +1446,41 @@ class TestSniffs(unittest.TestCase):
 
         assert arg_names(closure) == ["a", "b", "c", "d", "e", "f"], f"Expected ['a', 'b', 'c', 'd', 'e', 'f'], but got {arg_names(closure)}"
 
+    def test_is_async(self):
+        def closure():
+            nonlocal bar
+
+        async def async_closure():
+            nonlocal bar
+
+        bar = 0
+        self.assertEqual(
+            [is_async(f) for f in (async_foo, sync_foo, bound_foo, closure, async_closure)],
+            [True, False, False, False, True],
+        )
+
+    def test_sync_handler(self):
+        async def run_test():
+            new_sniffs = Sniffs(metrics=True)
+
+            @new_sniffs.route("lights/<light>")
+            def set_light(light, message):
+                return light, message
+
+            async def wait_for_result():
+                return await set_light.fetch_next_result()
+
+            waiter = asyncio.create_task(wait_for_result())
+            await asyncio.sleep(0)
+            output = await new_sniffs.router.route("lights/hall", "on")
+            self.assertEqual(output, (("hall", "on"),))
+            self.assertEqual(await waiter, ("hall", "on"))  # awaitable returns are still triggered
+            self.assertEqual(new_sniffs.stats()["routes"][0]["calls"], 1)
+            with self.assertRaises(Exception):
+                new_sniffs.route("lights/+", timeout_ms=10)(set_light)
+
+        asyncio.run(run_test())
+
     # In order to properly test on_connect and on_disconnect, I would need to rewire up
     # the integration testing. Not an immediate priority, but I'll put it on the list of
     # things to do.
@@ -1,60 +1,340 @@
 import asyncio
+import json
 
+from usniffs.buffer import MessageBuffer, BLOCK, DROP_OLDEST, DROP_NEWEST, KEEP_LATEST
+from usniffs.dispatch import Dispatcher
 from usniffs.returns import AwaitableReturns
-from usniffs.router import Router
+from usniffs.payload import STR, BYTES, MEMORYVIEW, register_decoder
+from usniffs.router import Router, SHED, DEMOTE
+from usniffs.utils import ticks_ms, ticks_diff
 
 
 class Sniffs:
     """A dynamic wrapper for the mqtt_as client (mqtt_as wrote by Peter Hinch)."""
 
-    def __init__(self, on_connect=None, on_disconnect=None, *args, **kwargs):
+    def __init__(
+        self,
+        on_connect=None,
+        on_disconnect=None,
+        *args,
+        concurrency=None,
+        priorities=1,
+        weights=None,
+        backlog=None,
+        backlog_policy=None,
+        buffer_size=None,
+        overload=BLOCK,
+        subscription_limit=32,
+        subscribe_in_flight=4,
+        match_cache_size=0,
+        metrics=False,
+        metrics_topic=None,
+        metrics_interval=60,
+        compiled=None,
+        retained_cache_size=0,
+        dedup_size=0,
+        dedup_window_ms=10000,
+        slow_after=3,
+        slow_ms=30000,
+        slow_policy=SHED,
+        worker_size=0,
+        outbox_size=16,
+        outbox_policy=DROP_OLDEST,
+        publish_rate=None,
+        **kwargs,
+    ):
+        if slow_policy == DEMOTE and not (concurrency and priorities > 1):
+            raise Exception("Slow policy DEMOTE needs concurrency and 2 or more priorities")
         self.client = None
         self._awaitable_returns = AwaitableReturns()
-        self.router = Router(self._awaitable_returns)
+        self.router = Router(
+            self._awaitable_returns,
+            subscription_limit=subscription_limit,
+            match_cache_size=match_cache_size,
+            metrics=metrics or bool(metrics_topic),
+            retained_cache_size=retained_cache_size,
+            dedup_size=dedup_size,
+            dedup_window_ms=dedup_window_ms,
+            slow_after=slow_after,
+            slow_ms=slow_ms,
+            slow_policy=slow_policy,
+        )
+        if compiled:  # module written by usniffs.compiler
+            self.router.load(compiled.ROUTES, compiled.SUBSCRIPTIONS)
+        if worker_size:
+            from usniffs.worker import Worker  # needs _thread, which not every port has
+
+            self.router.worker = Worker(self.router, worker_size)
+        self.dispatcher = None
+        if concurrency:
+            self.dispatcher = Dispatcher(
+                self.router, concurrency, priorities, weights, backlog, backlog_policy
+            )
+        self.buffer = MessageBuffer(buffer_size, overload) if buffer_size else None
+        if outbox_policy == BLOCK:
+            raise Exception("Outbox policy cannot be BLOCK, publish never waits for room")
+        self.outbox = MessageBuffer(outbox_size, outbox_policy)
+        self.publish_rate = publish_rate  # max publishes per second, None for no limit
+        self.published = 0  # messages handed to the client by the writer task
         self.on_connect = on_connect
         self.on_disconnect = on_disconnect
+        self.subscribe_in_flight = subscribe_in_flight
+        self.reconnect_ms = None  # time from the last connection to all filters being subscribed
+        self.metrics_topic = metrics_topic
+        self.metrics_interval = metrics_interval  # seconds between published snapshots
+        self.received = 0  # messages taken from the client queue, counted while metrics are enabled
+        self._connected = False
+        self._subscribed = set()  # filters subscribed to since the last connection
+        self._online = asyncio.Event()  # set while connected, the writer task waits on it
+        self._plans = {}  # dict[_AwaitableRoute, RoutePlan] of the registered routes
 
     async def bind(self, client):
         self.client = client
 
         asyncio.create_task(self._up())
         asyncio.create_task(self._messages())
+        if self.buffer:
+            asyncio.create_task(self._buffered_messages())
         asyncio.create_task(self._down())
+        asyncio.create_task(self._publisher())
+        if self.router.worker:
+            self.router.worker.start()
+        if self.metrics_topic:
+            asyncio.create_task(self._publish_stats())
 
         await asyncio.sleep(0)
 
-    def route(self, topic_route: str):
-        """A decorator for adding route registration."""
+    def route(self, topic_route: str, **options):
+        """
+        A decorator for adding route registration.
+
+        Args:
+            topic_route (str): MQTT topic template to match.
+            **options: Route options, see `add_route`.
+        """
 
         def decorator(func):
-            route = self._awaitable_returns.add_awaitable_route(topic_route)
-            self.router.register(topic_route, func)
-            return route
+            return self._register(topic_route, func, **options)
 
         return decorator
 
+    async def add_route(self, topic_route: str, func, **options):
+        """
+        Add a route while running, subscribing to any filter no other route already needed.
+
+        Args:
+            topic_route (str): MQTT topic template to match.
+            func (Callable): Handler of the route.
+            payload (str): How `message` is passed to the handler, one of STR, BYTES or MEMORYVIEW.
+            decoder (str|Callable|None): Decoder applied to the payload before it is passed as `message`.
+            depth (int): Unread results held for each consumer of the route's results.
+            history (int): Recent results a new consumer of the route's results starts with.
+            dedup (bool): Whether duplicate deliveries skip the route, when `dedup_size` is set.
+            priority (int): Dispatch class of the route, from 0 to `priorities` - 1, higher is more urgent.
+            timeout_ms (int|None): Time budget of the handler, it is cancelled when it runs longer.
+            threaded (bool): Run the plain handler on the worker thread, when `worker_size` is set.
+            share (str|None): Shared subscription group, to spread the route's messages across devices.
+            batch (int): Call the handler once per this many messages, with a `batch` argument.
+            batch_ms (int|None): Also call the handler this long after the first message of a batch.
+
+        Returns:
+            _AwaitableRoute: The route, to await its results or to pass to `remove_route`.
+        """
+        route = self._register(topic_route, func, **options)
+        if self._connected:
+            await self._resubscribe(added=self.router.exclusive_filters(self._plans[route]))
+        return route
+
+    async def remove_route(self, route) -> None:
+        """
+        Remove a route while running, unsubscribing from filters no other route needs.
+
+        Args:
+            route (_AwaitableRoute): The route, as returned by `add_route` or the `route` decorator.
+        """
+        plan = self._plans.pop(route)
+        released = self.router.unregister(plan)
+        self._awaitable_returns.remove_awaitable_route(route)
+        if self._connected:
+            await self._resubscribe(released=released)
+
+    async def _resubscribe(self, added=(), released=()) -> None:
+        """
+        Bring the subscriptions in line with the routes after one was added or removed,
+        subscribing before unsubscribing so no route goes without messages in between.
+
+        Args:
+            added (list[str]): Filters no route needed before the change.
+            released (list[str]): Filters no route needs after the change.
+        """
+        subscribe, unsubscribe = self.router.subscription_changes(self._subscribed, added, released)
+        await self._subscribe_all(subscribe)
+        for path in unsubscribe:
+            await self.client.unsubscribe(path)
+
+    def publish(self, topic: str, msg, retain: bool = False, qos: int = 0) -> bool:
+        """
+        Queue a message for the writer task to publish, without waiting for the broker.
+
+        Messages queued while disconnected are held in the outbox and published once the
+        connection is back up. When the outbox is full its `outbox_policy` decides what is
+        dropped; with KEEP_LATEST a queued message is replaced by a newer one on the same topic.
+
+        Args:
+            topic (str): MQTT topic to publish to.
+            msg (str|bytes): Payload.
+            retain (bool): Whether the broker retains the message.
+            qos (int): MQTT QoS level, 0 or 1.
+
+        Returns:
+            bool: False if the message was dropped.
+        """
+        return self.outbox.put_nowait((topic, msg, retain, qos))
+
+    def stats(self) -> dict:
+        """
+        Snapshot of the message and per route counters, collected while metrics are enabled.
+
+        Returns:
+            dict: Global counters, plus a "routes" list of per route counters.
+        """
+        return {
+            "received": self.received,
+            "unmatched": self.router.unmatched,
+            "suppressed": self.router.suppressed,
+            "duplicates": self.router.duplicates.duplicates if self.router.duplicates else 0,
+            "shed": self.router.shed,
+            "queue_depth": len(self.buffer) if self.buffer else 0,
+            "dropped": self.buffer.dropped if self.buffer else 0,
+            "pending": self.dispatcher.pending if self.dispatcher else 0,
+            "priorities": self.dispatcher.stats() if self.dispatcher else [],
+            "published": self.published,
+            "outbox_depth": len(self.outbox),
+            "outbox_dropped": self.outbox.dropped,
+            "routes": self.router.stats(),
+        }
+
+    def _register(
+        self,
+        topic_route: str,
+        func,
+        payload: str = STR,
+        decoder=None,
+        depth: int = 8,
+        history: int = 0,
+        dedup: bool = True,
+        priority: int = 0,
+        timeout_ms: int = None,
+        threaded: bool = False,
+        share: str = None,
+        batch: int = 0,
+        batch_ms: int = None,
+    ):
+        n_priorities = self.dispatcher.priorities if self.dispatcher else 1
+        if not 0 <= priority < n_priorities:
+            raise Exception(
+                f"Route priority must be from 0 to {n_priorities - 1}, got {priority} (priorities need concurrency)"
+            )
+        route = self._awaitable_returns.add_awaitable_route(topic_route, depth, history)
+        self._plans[route] = self.router.register(
+            topic_route,
+            func,
+            payload,
+            decoder,
+            dedup,
+            priority,
+            timeout_ms,
+            threaded,
+            share,
+            batch,
+            batch_ms,
+        )
+        return route
+
     async def _up(self):
         while True:
             await self.client.up.wait()
             self.client.up.clear()
 
             print("We are connected to broker.")
+            self._connected = True  # routes added from now on subscribe themselves
+            start = ticks_ms()
             paths = self.router.get_topic_paths()
-            for path in paths:
-                await self.client.subscribe(path)
+            self._subscribed = set(paths)
+            await self._subscribe_all(paths)
+            self.reconnect_ms = ticks_diff(ticks_ms(), start)
+            self._online.set()  # flush messages published while offline
 
             if self.on_connect:
                 await self.on_connect()
 
+    async def _subscribe_all(self, paths):
+        """
+        Subscribe to every path, keeping up to `subscribe_in_flight` subscriptions waiting on
+        their acknowledgement at once instead of paying a broker round trip per path.
+        """
+        remaining = iter(paths)
+
+        async def subscriber():
+            for path in remaining:
+                await self.client.subscribe(path)
+
+        n_subscribers = min(self.subscribe_in_flight, len(paths))
+        await asyncio.gather(*[subscriber() for _ in range(n_subscribers)])
+
     async def _down(self):
         while True:
             await self.client.down.wait()  # Pause until outage
             self.client.down.clear()
+            self._connected = False
+            self._online.clear()
             print("WiFi or broker is down.")
 
             if self.on_disconnect:
                 await self.on_disconnect()
 
+    async def _publish_stats(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            if self._connected:
+                self.publish(self.metrics_topic, json.dumps(self.stats()))
+
+    async def _publisher(self):
+        """Single writer task, publishing outbox messages in order while connected."""
+        last = None
+        while True:
+            await self._online.wait()  # offline messages stay in the outbox, where they coalesce
+            topic, msg, retain, qos = await self.outbox.get()
+            if self.publish_rate:
+                interval = 1000 // self.publish_rate
+                if last is not None:
+                    wait = interval - ticks_diff(ticks_ms(), last)
+                    if wait > 0:
+                        await asyncio.sleep(wait / 1000)
+                last = ticks_ms()
+            try:
+                await self.client.publish(topic, msg, retain, qos)
+            except Exception as e:  # a bad message must not stop the writer for every later one
+                print(f"Exception publishing to {topic}: {repr(e)}")
+                continue
+            self.published += 1
+
     async def _messages(self):
         async for topic, msg, retained in self.client.queue:
-            await self.router.route(topic.decode(), msg.decode())
+            if self.router.metrics:
+                self.received += 1
+            if self.buffer:
+                await self.buffer.put((topic, msg, retained))
+            else:
+                await self._handle(topic, msg, retained)
+
+    async def _buffered_messages(self):
+        while True:
+            topic, msg, retained = await self.buffer.get()
+            await self._handle(topic, msg, retained)
+
+    async def _handle(self, topic, msg, retained):
+        if self.dispatcher:
+            await self.dispatcher.dispatch(topic, msg, retained)
+        else:
+            await self.router.route(topic, msg, retained)
@@ -0,0 +1,115 @@
+import asyncio
+from array import array
+
+from usniffs.utils import ticks_ms, ticks_diff
+
+
+# Decoders whose results are stored in an array rather than a list, by array typecode.
+NUMERIC = {"int": "i", "float": "f"}
+# Largest value of the integer typecodes. MicroPython arrays silently truncate values out of range,
+# so `Batcher.add` checks them itself.
+INT_LIMITS = {"i": 0x7FFFFFFF}
+
+
+class Batch:
+    """
+    Messages of one window of a batched route, passed to its handler as `batch`.
+
+    Iterating gives a (topic, captures, payload) tuple per message, where captures are the
+    values of the route's placeholders in template order. `payloads` holds the payloads alone,
+    in an array when the route decodes them with "int" or "float". A batch is reused for a later
+    window once its handler returns, so the handler must not keep it.
+    """
+
+    def __init__(self, size: int, typecode: str = None):
+        self.topics = [None] * size
+        self.captures = [None] * size
+        self._payloads = array(typecode, [0] * size) if typecode else [None] * size
+        self._count = 0
+        self.opened = 0  # ticks_ms when the window's first message was added
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self):
+        topics = self.topics
+        captures = self.captures
+        payloads = self._payloads
+        for n in range(self._count):
+            yield topics[n], captures[n], payloads[n]
+
+    @property
+    def payloads(self):
+        """Payloads of the window: a memoryview of the array for numeric payloads, else a list."""
+        if isinstance(self._payloads, list):
+            return self._payloads[:self._count]
+        return memoryview(self._payloads)[:self._count]
+
+    def clear(self) -> None:
+        for n in range(self._count):
+            self.topics[n] = None
+            self.captures[n] = None
+            if isinstance(self._payloads, list):
+                self._payloads[n] = None
+        self._count = 0
+
+
+class Batcher:
+    """
+    Collects the messages of a batched route into windows of up to `size` messages, closed
+    when full or `window_ms` after their first message. Two batches are swapped, so messages
+    keep being collected while the handler of the last window runs.
+    """
+
+    def __init__(self, size: int, window_ms: int = None, typecode: str = None, sources: tuple = ()):
+        if size < 1:
+            raise Exception(f"Batch size must be 1 or greater, got {size}")
+        self.size = size
+        self.window_ms = window_ms
+        self.typecode = typecode
+        self._limit = INT_LIMITS.get(typecode)
+        self.sources = sources  # arg_map style source of each placeholder, in template order
+        self.batch = Batch(size, typecode)  # the open window
+        self.windows = 0  # windows closed so far, identifies the open window
+        self._spare = None  # Batch whose handler has returned, reused for the next window
+        self.lock = asyncio.Lock()  # held while the handler runs, so windows are handled in turn
+
+    def add(self, topic: str, captures: tuple, payload):
+        """
+        Add a message to the open window.
+
+        Returns:
+            Batch|None: The window, if the message closed it.
+        """
+        limit = self._limit
+        if limit is not None and not -limit - 1 <= payload <= limit:
+            raise OverflowError(f"{payload} does not fit in array typecode {self.typecode}")
+        batch = self.batch
+        n = batch._count
+        batch._payloads[n] = payload  # first, so a payload the array cannot hold changes nothing
+        batch.topics[n] = topic
+        batch.captures[n] = captures
+        n += 1
+        batch._count = n
+        if n == self.size:
+            return self.take()
+        if self.window_ms is not None:  # only timed windows read the clock
+            if n == 1:
+                batch.opened = ticks_ms()
+            elif ticks_diff(ticks_ms(), batch.opened) >= self.window_ms:
+                return self.take()
+        return None
+
+    def take(self) -> Batch:
+        """Close the open window and start the next one."""
+        batch = self.batch
+        spare = self._spare
+        self._spare = None
+        self.batch = spare if spare is not None else Batch(self.size, self.typecode)
+        self.windows += 1
+        return batch
+
+    def release(self, batch: Batch) -> None:
+        """Take back a closed window once its handler has returned."""
+        batch.clear()
+        self._spare = batch
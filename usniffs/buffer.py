@@ -0,0 +1,102 @@
+import asyncio
+
+
+BLOCK = "block"              # wait for room, the producer is held back
+DROP_OLDEST = "drop_oldest"  # make room by discarding the oldest buffered item
+DROP_NEWEST = "drop_newest"  # discard the item being added
+KEEP_LATEST = "keep_latest"  # replace the buffered item with the same topic, else drop the oldest
+
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, KEEP_LATEST)
+
+
+class MessageBuffer:
+    """
+    Fixed capacity FIFO of message tuples whose first element is the topic.
+
+    Items are stored in a ring allocated up front, so the buffer never grows past `capacity`
+    however fast items are added. What happens when it is full is decided by `policy`, and every
+    discarded item is counted in `dropped`.
+    """
+
+    def __init__(self, capacity: int, policy: str = BLOCK):
+        if capacity < 1:
+            raise Exception(f"Buffer capacity must be 1 or greater, got {capacity}")
+        if policy not in POLICIES:
+            raise Exception(f"Unknown overload policy {policy}, expected one of {POLICIES}")
+        self.capacity = capacity
+        self.policy = policy
+        self.dropped = 0
+        self._items = [None] * capacity
+        self._head = 0
+        self._count = 0
+        self._slots = {} if policy == KEEP_LATEST else None  # dict[topic, int] of buffered topics
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def put_nowait(self, item: tuple) -> bool:
+        """
+        Add an item without waiting, applying the overload policy if the buffer is full.
+
+        Args:
+            item (tuple): Message tuple, starting with its topic.
+
+        Returns:
+            bool: False if the item itself was dropped.
+        """
+        slots = self._slots
+        if slots is not None:
+            slot = slots.get(item[0])
+            if slot is not None:
+                self._items[slot] = item
+                self.dropped += 1  # the replaced item is never delivered
+                return True
+        if self._count == self.capacity:
+            self.dropped += 1
+            if self.policy == DROP_NEWEST or self.policy == BLOCK:
+                return False
+            self._pop()
+        slot = (self._head + self._count) % self.capacity
+        self._items[slot] = item
+        self._count += 1
+        if slots is not None:
+            slots[item[0]] = slot
+        self._not_empty.set()
+        return True
+
+    async def put(self, item: tuple) -> bool:
+        """
+        Add an item, waiting for room first when the policy is BLOCK.
+
+        Args:
+            item (tuple): Message tuple, starting with its topic.
+
+        Returns:
+            bool: False if the item itself was dropped.
+        """
+        if self.policy == BLOCK:
+            while self._count == self.capacity:
+                self._not_full.clear()
+                await self._not_full.wait()
+        return self.put_nowait(item)
+
+    async def get(self) -> tuple:
+        """Remove and return the oldest item, waiting for one if the buffer is empty."""
+        while not self._count:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        item = self._pop()
+        self._not_full.set()
+        return item
+
+    def _pop(self) -> tuple:
+        head = self._head
+        item = self._items[head]
+        self._items[head] = None
+        self._head = (head + 1) % self.capacity
+        self._count -= 1
+        if self._slots is not None:
+            del self._slots[item[0]]
+        return item
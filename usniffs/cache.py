@@ -0,0 +1,65 @@
+class ClockCache:
+    """
+    Fixed size key/value cache with approximately least recently used eviction.
+
+    MicroPython dicts do not keep insertion order, so instead of an ordered LRU this uses the
+    CLOCK algorithm: every entry has a referenced bit set on use, and eviction sweeps a hand over
+    the slots, clearing set bits and evicting the first entry whose bit was already clear. All
+    storage is allocated up front, and `hits`, `misses` and `evictions` are counted.
+    """
+
+    def __init__(self, size: int):
+        if size < 1:
+            raise Exception(f"Cache size must be 1 or greater, got {size}")
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._keys = [None] * size
+        self._values = [None] * size
+        self._referenced = bytearray(size)
+        self._slots = {}  # dict[key, int]
+        self._hand = 0
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def get(self, key, default=None):
+        slot = self._slots.get(key)
+        if slot is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._referenced[slot] = 1
+        return self._values[slot]
+
+    def put(self, key, value) -> None:
+        slot = self._slots.get(key)
+        if slot is None:
+            if len(self._slots) < self.size:
+                slot = len(self._slots)
+            else:
+                slot = self._evict()
+            self._keys[slot] = key
+            self._slots[key] = slot
+        self._values[slot] = value
+        self._referenced[slot] = 1
+
+    def clear(self) -> None:
+        for slot in range(self.size):
+            self._keys[slot] = None
+            self._values[slot] = None
+            self._referenced[slot] = 0
+        self._slots.clear()
+        self._hand = 0
+
+    def _evict(self) -> int:
+        referenced = self._referenced
+        hand = self._hand
+        while referenced[hand]:
+            referenced[hand] = 0
+            hand = (hand + 1) % self.size
+        del self._slots[self._keys[hand]]
+        self.evictions += 1
+        self._hand = (hand + 1) % self.size
+        return hand
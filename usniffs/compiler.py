@@ -0,0 +1,56 @@
+"""
+Ahead of time route compiler. Runs on CPython or the micropython unix port, not on the device:
+
+    $ python3 -m usniffs.compiler <module>:<sniffs attribute> <output file>
+    $ python3 -m usniffs.compiler app_routes:sniffs routes_compiled.py
+
+Imports the module (so its `@sniffs.route` decorators run), then writes the parsed templates,
+handler argument maps and subscription filters of every route into a plain data module. On the
+device, `Sniffs(compiled=routes_compiled)` registers routes from that module instead of
+compiling them at boot. The generated module can be frozen into firmware or built into a `.mpy`
+with mpy-cross.
+"""
+
+import sys
+
+
+def render(sniffs, source: str = "") -> str:
+    """
+    Generate the source of a compiled routes module.
+
+    Args:
+        sniffs (Sniffs): Instance whose routes are compiled.
+        source (str): Where the routes came from, noted in the generated module.
+
+    Returns:
+        str: Python source defining ROUTES and SUBSCRIPTIONS.
+    """
+    routes, subscriptions = sniffs.router.export()
+    lines = [f"# Routes compiled by usniffs.compiler{' from ' + source if source else ''}, do not edit.", ""]
+    lines.append("ROUTES = (")
+    for entry in routes:
+        lines.append(f"    {repr(entry)},")
+    lines.append(")")
+    lines.append("")
+    lines.append("SUBSCRIPTIONS = (")
+    for topic_filter in subscriptions:
+        lines.append(f"    {repr(topic_filter)},")
+    lines.append(")")
+    lines.append("")
+    return "\n".join(lines)
+
+
+def main(argv: list) -> None:
+    if len(argv) != 2 or ":" not in argv[0]:
+        print("usage: python3 -m usniffs.compiler <module>:<sniffs attribute> <output file>")
+        sys.exit(2)
+    module_name, attribute = argv[0].split(":")
+    module = __import__(module_name)
+    for part in module_name.split(".")[1:]:
+        module = getattr(module, part)
+    with open(argv[1], "w") as output:
+        output.write(render(getattr(module, attribute), argv[0]))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,65 @@
+from usniffs.utils import ticks_ms, ticks_diff
+
+
+class DuplicateWindow:
+    """
+    Recently received messages, to recognise QoS 1 redeliveries.
+
+    The last `size` messages are kept in a ring of their topic, the hash and length of their
+    payload, and the time they were received. A message is a duplicate when a message with the
+    same topic, payload hash and payload length is in the ring and was received less than
+    `window_ms` ago. The topic is compared itself rather than folded into the hash, since on
+    MicroPython str and bytes hashes are short enough for unrelated messages to collide. The
+    ring is allocated up front and checking a message scans it once, so the cost per message is
+    fixed and nothing is allocated.
+    """
+
+    def __init__(self, size: int, window_ms: int):
+        if size < 1:
+            raise Exception(f"Duplicate window size must be 1 or greater, got {size}")
+        self.size = size
+        self.window_ms = window_ms
+        self.duplicates = 0
+        self._topics = [None] * size  # Router.topic reuses str objects, so these are shared
+        self._hashes = [0] * size
+        self._lengths = [0] * size
+        self._times = [0] * size
+        self._count = 0
+        self._hand = 0
+
+    def seen(self, topic, message) -> bool:
+        """
+        Record a message, checking whether it was already received within the window.
+
+        Args:
+            topic (str): MQTT topic of the received message.
+            message (bytes|str): Payload of the received message.
+
+        Returns:
+            bool: True if the same message was received less than `window_ms` ago.
+        """
+        digest = hash(message)
+        length = len(message)
+        now = ticks_ms()
+        topics = self._topics
+        hashes = self._hashes
+        lengths = self._lengths
+        times = self._times
+        for slot in range(self._count):
+            if (
+                hashes[slot] == digest
+                and lengths[slot] == length
+                and topics[slot] == topic
+                and ticks_diff(now, times[slot]) < self.window_ms
+            ):
+                self.duplicates += 1
+                return True
+        hand = self._hand
+        topics[hand] = topic
+        hashes[hand] = digest
+        lengths[hand] = length
+        times[hand] = now
+        self._hand = (hand + 1) % self.size
+        if self._count < self.size:
+            self._count += 1
+        return False
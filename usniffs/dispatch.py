@@ -0,0 +1,244 @@
+import asyncio
+
+from usniffs.buffer import BLOCK, DROP_OLDEST, DROP_NEWEST
+from usniffs.payload import DECODE_FAILED
+from usniffs.router import Router, DEMOTE
+from usniffs.utils import ticks_us, ticks_diff
+
+
+# Indexes into the per class lists of `Dispatcher.waits`.
+STARTED = 0
+WAIT_TOTAL_US = 1
+WAIT_MAX_US = 2
+
+
+class Dispatcher:
+    """
+    Runs route handlers as asyncio tasks instead of awaiting them one after another.
+
+    At most `limit` handlers run at any time. Each route drains its own queue from a single
+    task, so a route always sees its messages (and triggers its awaitable returns) in the order
+    they arrived, while different routes run in parallel.
+
+    Routes belong to one of `priorities` classes, set by their `priority` (higher is more
+    urgent). Every class holds at most `backlog` messages queued or running. When a class is full,
+    `overload` decides what happens to its next message: with one class, BLOCK holds back the
+    caller until there is room; with several, a message is dropped instead (DROP_OLDEST by
+    default, or DROP_NEWEST) so that a saturated class never holds back messages of the others.
+    Dropped messages are counted per class in `dropped`. When routes of several classes wait to
+    run, a free slot goes to the most urgent class. With `weights`, classes instead share slots in
+    proportion to their weight, so less urgent classes are never starved. How long messages of
+    each class waited for a slot is counted in `waits`.
+    """
+
+    def __init__(
+        self,
+        router: Router,
+        limit: int,
+        priorities: int = 1,
+        weights: tuple = None,
+        backlog: int = None,
+        overload: str = None,
+    ):
+        if limit < 1:
+            raise Exception(f"Dispatcher limit must be 1 or greater, got {limit}")
+        if weights is not None and (len(weights) != priorities or min(weights) < 1):
+            raise Exception(f"Expected {priorities} weights of 1 or greater, got {weights}")
+        if overload is None:
+            overload = BLOCK if priorities == 1 else DROP_OLDEST
+        if overload not in (BLOCK, DROP_OLDEST, DROP_NEWEST):
+            raise Exception(f"Unknown backlog policy {overload}, expected BLOCK or a DROP policy")
+        if overload == BLOCK and priorities > 1:
+            raise Exception("Backlog policy cannot be BLOCK with several priority classes")
+        if router.slow_policy == DEMOTE:
+            if priorities < 2:
+                raise Exception("Slow policy DEMOTE needs 2 or more priority classes")
+            router.demotes = True
+        self.router = router
+        router.dispatcher = self  # windows closed by `batch_ms` are queued here too
+        self.limit = limit
+        self.priorities = priorities
+        self.weights = weights  # slots per round granted to each class, None for strict priority
+        self.backlog = backlog or limit  # messages queued or running per class
+        self.overload = overload
+        self.dropped = [0] * priorities  # messages dropped from full classes, per class
+        self.pending = 0  # messages queued or running, across all routes
+        self.queued = [0] * priorities  # messages queued or running, per class
+        self.waits = [[0, 0, 0] for _ in range(priorities)]  # per class, indexed by STARTED, ...
+        self._running = 0
+        self._waiters = [[] for _ in range(priorities)]  # Events of routes waiting for a slot
+        self._credits = list(weights) if weights else None
+        self._queues = {}  # dict[RoutePlan, list[tuple]], only for routes with a running task
+        self._room = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def dispatch(self, topic, message, retained: bool = False) -> None:
+        """
+        Queue a received message for every matching route. When a route's class is full, this
+        waits for room with the BLOCK policy, and otherwise drops a message.
+
+        Args:
+            topic (bytes|str): MQTT topic of the received message.
+            message (bytes|str): Payload of the received message.
+            retained (bool): Whether the broker flagged the message as retained.
+        """
+        router = self.router
+        topic, matched, levels = router.receive(topic, message, retained)
+        if not matched:
+            return
+        values = router.payloads(matched, message)
+        for n in range(len(matched)):
+            plan = matched[n]
+            value = values[n]
+            if value is DECODE_FAILED:
+                continue
+            if plan.batcher is not None:
+                value = router.collect(plan, topic, value, levels)
+                if value is None or value is DECODE_FAILED:  # window still open, or payload did not fit
+                    continue
+            await self.enqueue(plan, topic, value, levels)
+
+    async def enqueue(self, plan, topic: str, message, levels: list) -> None:
+        """
+        Queue one message for a route, behind the route's earlier messages.
+
+        Args:
+            plan (RoutePlan): The matched route.
+            topic (str): MQTT topic of the received message.
+            message: Payload, as returned by `Router.payloads`, or a closed Batch.
+            levels (list[str]|None): Topic levels, as returned by `Router.match`.
+        """
+        priority = plan.priority
+        if self.overload == BLOCK:
+            while self.queued[priority] >= self.backlog:
+                self._room.clear()
+                await self._room.wait()
+        elif self.queued[priority] >= self.backlog:
+            if self.overload == DROP_NEWEST or not self._drop_oldest(priority):
+                self.dropped[priority] += 1
+                if plan.batcher is not None:
+                    plan.batcher.release(message)
+                return
+        self.queued[priority] += 1
+        self.pending += 1
+        self._idle.clear()
+        item = (topic, message, levels, ticks_us(), priority)
+        queue = self._queues.get(plan)
+        if queue is None:
+            self._queues[plan] = [item]
+            asyncio.create_task(self._drain(plan))
+        else:
+            queue.append(item)
+
+    async def wait_idle(self) -> None:
+        """Wait until every queued message has been handled."""
+        await self._idle.wait()
+
+    def stats(self) -> list:
+        """
+        Snapshot of the per class counters.
+
+        Returns:
+            list[dict]: One dict per priority class, from the least urgent.
+        """
+        return [
+            {
+                "priority": priority,
+                "queued": self.queued[priority],
+                "dropped": self.dropped[priority],
+                "started": waits[STARTED],
+                "wait_total_us": waits[WAIT_TOTAL_US],
+                "wait_max_us": waits[WAIT_MAX_US],
+            }
+            for priority, waits in enumerate(self.waits)
+        ]
+
+    async def _drain(self, plan) -> None:
+        queue = self._queues[plan]
+        while queue:
+            # The class is the route's priority at dispatch, it changes when the route is demoted.
+            topic, message, levels, queued_at, priority = queue.pop(0)
+            await self._acquire(priority)
+            waited = ticks_diff(ticks_us(), queued_at)
+            waits = self.waits[priority]
+            waits[STARTED] += 1
+            waits[WAIT_TOTAL_US] += waited
+            if waited > waits[WAIT_MAX_US]:
+                waits[WAIT_MAX_US] = waited
+            try:
+                if plan.batcher is not None:
+                    await self.router.flush(plan, message)
+                elif plan.threaded and self.router.worker is not None:
+                    await self.router.worker.submit(plan, topic, message, levels)
+                elif plan.is_async:
+                    await self.router.call(plan, topic, message, levels)
+                else:
+                    self.router.call_sync(plan, topic, message, levels)
+            except Exception as e:
+                print(f"Exception in route {plan.topic_route}: {repr(e)}")
+            self._release()
+            self.queued[priority] -= 1
+            self.pending -= 1
+            self._room.set()
+        del self._queues[plan]
+        if not self.pending:
+            self._idle.set()
+
+    def _drop_oldest(self, priority: int) -> bool:
+        """
+        Drop the oldest message of a class that is still queued, not waiting for or holding a slot.
+
+        Returns:
+            bool: False if every message of the class has already been taken by its route's task.
+        """
+        oldest = None  # (plan, queue, index, queued_at)
+        for plan, queue in self._queues.items():
+            for n in range(len(queue)):  # each route's messages are in arrival order
+                queued_at = queue[n][3]
+                if queue[n][4] == priority:
+                    if oldest is None or ticks_diff(queued_at, oldest[3]) < 0:
+                        oldest = (plan, queue, n, queued_at)
+                    break
+        if oldest is None:
+            return False
+        plan, queue, n, _ = oldest
+        item = queue.pop(n)
+        if plan.batcher is not None:
+            plan.batcher.release(item[1])
+        self.dropped[priority] += 1
+        self.queued[priority] -= 1
+        self.pending -= 1
+        return True
+
+    async def _acquire(self, priority: int) -> None:
+        """Wait for one of the `limit` slots to run a handler in."""
+        if self._running < self.limit:
+            self._running += 1
+            return
+        ready = asyncio.Event()
+        self._waiters[priority].append(ready)
+        await ready.wait()  # `_release` hands its slot over, so `_running` is unchanged
+
+    def _release(self) -> None:
+        priority = self._next_priority()
+        if priority is None:
+            self._running -= 1
+        else:
+            self._waiters[priority].pop(0).set()
+
+    def _next_priority(self):
+        """The class to hand a freed slot to, or None if no route is waiting for one."""
+        waiters = self._waiters
+        credits = self._credits
+        for priority in range(self.priorities - 1, -1, -1):
+            if waiters[priority] and (credits is None or credits[priority]):
+                if credits is not None:
+                    credits[priority] -= 1
+                return priority
+        if credits is None or not any(waiters):
+            return None
+        # Every waiting class has used its share of this round, start the next one.
+        for priority in range(self.priorities):
+            credits[priority] = self.weights[priority]
+        return self._next_priority()
@@ -0,0 +1,65 @@
+import json
+import struct
+
+
+STR = "str"                # the payload decoded as utf-8, decoded once per message
+BYTES = "bytes"            # the raw payload
+MEMORYVIEW = "memoryview"  # a memoryview over the raw payload, no copy is made
+
+PAYLOAD_MODES = (STR, BYTES, MEMORYVIEW)
+
+DECODE_FAILED = object()  # stands in for the value of a payload its decoder rejected
+
+
+# Decoders by name (or by the callable users are most likely to pass), each paired with the
+# payload mode its input is given in.
+_decoders = {
+    "json": (json.loads, STR),
+    json.loads: (json.loads, STR),
+    "int": (int, STR),
+    int: (int, STR),
+    "float": (float, STR),
+    float: (float, STR),
+}
+
+STRUCT_PREFIX = "struct:"
+
+
+def register_decoder(name: str, decoder, payload: str = STR) -> None:
+    """
+    Make a decoder available by name to `Sniffs.route(..., decoder=name)`.
+
+    Args:
+        name (str): Name used to select the decoder.
+        decoder (Callable): Called with the payload, returns the decoded value or raises.
+        payload (str): Payload mode the decoder expects its input in.
+    """
+    if payload not in PAYLOAD_MODES:
+        raise Exception(f"Unknown payload mode {payload}, expected one of {PAYLOAD_MODES}")
+    _decoders[name] = (decoder, payload)
+
+
+def resolve_decoder(decoder, payload: str) -> tuple:
+    """
+    Look up the decoder of a route.
+
+    Args:
+        decoder (str|Callable|None): Registered name, "struct:<format>", or any callable.
+        payload (str): Payload mode of the route, used as the input of unregistered callables.
+
+    Returns:
+        tuple[Callable|None, str]: The decoder and the payload mode its input is given in.
+    """
+    if decoder is None:
+        return None, payload
+    entry = _decoders.get(decoder)
+    if entry is not None:
+        return entry
+    if isinstance(decoder, str):
+        if decoder.startswith(STRUCT_PREFIX):
+            fmt = decoder[len(STRUCT_PREFIX):]
+            struct.calcsize(fmt)  # fail at registration on a bad format
+            register_decoder(decoder, lambda payload: struct.unpack(fmt, payload), BYTES)
+            return _decoders[decoder]
+        raise Exception(f"Unknown decoder {decoder}")
+    return decoder, payload
@@ -1,19 +1,135 @@
 import asyncio
 
 
+class _Consumer:
+    """
+    One reader of an awaitable route's results.
+
+    Holds the results it has not read yet in a ring of `depth` slots. When the ring is full the
+    oldest unread result is dropped and counted in `overflows`.
+
+    A consumer receives results until it is closed, and breaking out of an `async for` over it
+    does not close it, so use it as `async with route.subscribe() as consumer`. It also closes
+    itself when the task waiting on it is cancelled.
+    """
+
+    __slots__ = ("_route", "_values", "_head", "_count", "overflows", "_ready")
+
+    def __init__(self, route, depth: int):
+        self._route = route
+        self._values = [None] * depth
+        self._head = 0
+        self._count = 0
+        self.overflows = 0
+        self._ready = None  # asyncio.Event, only created once the consumer waits
+
+    def __len__(self) -> int:
+        return self._count
+
+    def push(self, value) -> None:
+        depth = len(self._values)
+        if self._count == depth:
+            self._head = (self._head + 1) % depth
+            self._count -= 1
+            self.overflows += 1
+            self._route.overflows += 1
+        self._values[(self._head + self._count) % depth] = value
+        self._count += 1
+        if self._ready is not None:
+            self._ready.set()
+
+    def close(self) -> None:
+        """Stop receiving results."""
+        self._route.unsubscribe(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._count:
+            if self._ready is None:
+                self._ready = asyncio.Event()
+            self._ready.clear()
+            try:
+                await self._ready.wait()
+            except asyncio.CancelledError:
+                self.close()
+                raise
+        head = self._head
+        value = self._values[head]
+        self._values[head] = None
+        self._head = (head + 1) % len(self._values)
+        self._count -= 1
+        return value
+
+
 class _AwaitableRoute:
-    def __init__(self, route):
+    __slots__ = (
+        "_route", "result", "depth", "overflows", "_ready", "_consumers", "_history_len", "_history"
+    )
+
+    def __init__(self, route, depth: int = 8, history: int = 0):
         self._route = route
         self.result = None
-        self.ready = asyncio.Event()
+        self.depth = depth
+        self.overflows = 0  # results dropped across all consumers
+        self._ready = None  # asyncio.Event, only created while someone awaits the route
+        self._consumers = None  # list[_Consumer], created by the first subscribe
+        self._history_len = history
+        self._history = None  # list of the last `history` results, created by the first trigger
 
     def trigger(self, result):
         self.result = result
-        self.ready.set()
+        ready = self._ready
+        if ready is not None:
+            self._ready = None  # waiters hold the old event, later awaits get a new one
+            ready.set()
+        if self._consumers:
+            for consumer in self._consumers:
+                consumer.push(result)
+        if self._history_len:
+            history = self._history
+            if history is None:
+                history = self._history = []
+            elif len(history) == self._history_len:
+                history.pop(0)
+            history.append(result)
+
+    def subscribe(self, depth: int = None) -> _Consumer:
+        """
+        Start receiving every result of the route, in order.
+
+        Args:
+            depth (int): Number of unread results to hold before the oldest is dropped,
+                defaults to the depth the route was created with.
+
+        Returns:
+            _Consumer: Async iterator of results, starting with the route's history, to close
+            once done with it (or use with `async with`).
+        """
+        consumer = _Consumer(self, depth or self.depth)
+        for result in self._history or ():
+            consumer.push(result)
+        if self._consumers is None:
+            self._consumers = []
+        self._consumers.append(consumer)
+        return consumer
+
+    def unsubscribe(self, consumer: _Consumer) -> None:
+        if self._consumers and consumer in self._consumers:
+            self._consumers.remove(consumer)
 
     async def fetch_next_result(self):
-        await self.ready.wait()
-        self.ready.clear()
+        ready = self._ready
+        if ready is None:
+            ready = self._ready = asyncio.Event()
+        await ready.wait()
         return self.result  # updated when triggered
 
     def __await__(self):
@@ -27,11 +143,16 @@ class AwaitableReturns:
     def __init__(self):
         self._awaitable_routes = {}
 
-    def add_awaitable_route(self, route: str) -> _AwaitableRoute:
-        awaitable_route = _AwaitableRoute(route)
+    def add_awaitable_route(self, route: str, depth: int = 8, history: int = 0) -> _AwaitableRoute:
+        awaitable_route = _AwaitableRoute(route, depth, history)
         self._awaitable_routes[route] = awaitable_route
         return awaitable_route
 
+    def remove_awaitable_route(self, awaitable_route: _AwaitableRoute) -> None:
+        route = awaitable_route._route
+        if self._awaitable_routes.get(route) is awaitable_route:
+            del self._awaitable_routes[route]
+
     def trigger_awaitable_route(self, route: str, result) -> None:
         if self._awaitable_routes.get(route):
             self._awaitable_routes[route].trigger(result)
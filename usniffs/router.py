@@ -1,7 +1,13 @@
-import re
+import asyncio
 
-from usniffs.utils import arg_names, re_escape, itertools_product, match_groups
+from usniffs.batch import NUMERIC, Batcher
+from usniffs.cache import ClockCache
+from usniffs.dedup import DuplicateWindow
+from usniffs.utils import arg_names, is_async, itertools_product, ticks_ms, ticks_us, ticks_diff
+from usniffs.payload import STR, BYTES, MEMORYVIEW, PAYLOAD_MODES, DECODE_FAILED, resolve_decoder
 from usniffs.returns import AwaitableReturns
+from usniffs.subscriptions import SHARE_PREFIX, covers, minimise, share_filter
+from usniffs.trie import TopicTrie, LITERAL, OPTIONS, WILDCARD, TAIL
 
 
 LV_T = "<"  # LHS VARIABLE TOKEN
@@ -11,23 +17,270 @@ V_D = ":"   # VARIABLE DELIMITER
 LO_T = "{"  # LHS OPTIONS TOKEN
 RO_T = "}"  # RHS OPTIONS TOKEN
 O_D = ","   # OPTIONS DELIMITER
+T_T = "..."  # TAIL TOKEN, ends the name of a placeholder capturing every remaining level
+
+
+TOPIC = -1    # arg_map source for the injected `topic` argument
+MESSAGE = -2  # arg_map source for the injected `message` argument
+REST = -3     # arg_map sources at or below REST capture the levels from `REST - source` onwards
+
+
+# What happens to a route that went over its time budget `slow_after` times in a row.
+SHED = "shed"      # its messages are skipped
+DEMOTE = "demote"  # it is dispatched in the least urgent priority class
+SLOW_POLICIES = (SHED, DEMOTE)
+
+
+# Indexes into `RoutePlan.counters`, which is only allocated once `Router.metrics` counts something.
+MATCHES = 0
+CALLS = 1
+ERRORS = 2
+TOTAL_US = 3
+MAX_US = 4
+
+
+class RoutePlan:
+    """
+    Compiled form of a registered route, built once by `Router.register` so that dispatching a
+    message only has to look values up rather than re-parse the template.
+
+    Options most routes leave alone, and counters most routes never move, are class attributes.
+    A route only stores one of them once it differs from the default, so on MicroPython, which
+    ignores `__slots__`, a route registered with default options holds 7 attributes rather than
+    19. On CPython the `__dict__` slot is only allocated for routes that set one.
+    """
+
+    __slots__ = (
+        "index",
+        "topic_route",
+        "callback",
+        "n_levels",
+        "arg_map",
+        "filters",
+        "wants_message",
+        "__dict__",  # for the class attribute defaults below, once a route changes one
+    )
+
+    payload = STR  # STR, BYTES or MEMORYVIEW, the input of the decoder if there is one
+    decoder = None  # Callable applied to the payload, or None
+    decode_errors = 0
+    counters = None  # list[int] indexed by MATCHES, CALLS, ... while metrics are enabled
+    dedup = True  # skipped for messages the router's duplicate window has already seen
+    priority = 0  # dispatch class, higher is more urgent
+    timeout_ms = None  # time budget of the handler, None for no limit
+    timeouts = 0  # calls cancelled for going over the time budget
+    strikes = 0  # calls in a row that went over the time budget
+    is_async = True  # False for plain functions, which are called without a coroutine
+    threaded = False  # handled on the `Router.worker` thread, when there is one
+    batcher = None  # Batcher collecting the messages of a batched route
+
+    def __init__(
+        self,
+        index: int,
+        topic_route: str,
+        callback,
+        n_levels: int,
+        arg_map: tuple,
+        payload: str,
+        decoder,
+    ):
+        self.index = index  # registration order, used to order results
+        self.topic_route = topic_route
+        self.callback = callback
+        self.n_levels = n_levels
+        self.arg_map = arg_map  # per callback argument: topic level index, TOPIC, MESSAGE or <= REST
+        if payload != STR:
+            self.payload = payload
+        if decoder is not None:
+            self.decoder = decoder
+        self.filters = ()  # subscription filters of the route, set by `Router.register`
+        self.wants_message = MESSAGE in arg_map
+
+    def count(self, counter: int, n: int = 1) -> list:
+        counters = self.counters
+        if counters is None:
+            counters = self.counters = [0, 0, 0, 0, 0]
+        counters[counter] += n
+        return counters
 
 
 class Router:
-    def __init__(self, awaitable_returns: AwaitableReturns):
+    def __init__(
+        self,
+        awaitable_returns: AwaitableReturns,
+        topic_cache_size: int = 64,
+        subscription_limit: int = 32,
+        match_cache_size: int = 0,
+        metrics: bool = False,
+        retained_cache_size: int = 0,
+        dedup_size: int = 0,
+        dedup_window_ms: int = 10000,
+        slow_after: int = 3,
+        slow_ms: int = 30000,
+        slow_policy: str = SHED,
+    ):
         self.routes = []
+        self._trie = TopicTrie()
+        # dict[str, tuple[RoutePlan]] for templates without placeholders. Tuples are replaced
+        # rather than changed, since `match` hands them out while routes are added and removed.
+        self._literals = {}
+        self._depths = {}  # dict[int, int] number of trie routes per topic level count
+        self._tails = 0  # number of trie routes ending in `#`, which match topics of any depth
+        self._filter_refs = {}  # dict[str, int] number of routes needing each subscription filter
+        self._next_index = 0
+        # topic -> `match` result of recently seen topics, or None when disabled
+        self.match_cache = ClockCache(match_cache_size) if match_cache_size else None
+        self.metrics = metrics  # count matches, calls, errors and handler time of every route
+        self.unmatched = 0  # messages no route matched, counted while metrics are enabled
+        # topic -> digest of the last payload delivered, or None when retained replays are not suppressed
+        self.retained_cache = ClockCache(retained_cache_size) if retained_cache_size else None
+        self.suppressed = 0  # retained messages skipped because their payload was already delivered
+        # recently received messages, to skip QoS 1 redeliveries, or None when disabled
+        self.duplicates = DuplicateWindow(dedup_size, dedup_window_ms) if dedup_size else None
+        if slow_policy not in SLOW_POLICIES:
+            raise Exception(f"Unknown slow route policy {slow_policy}, expected one of {SLOW_POLICIES}")
+        self.slow_after = slow_after  # timeouts in a row before a route is shed or demoted, 0 never
+        self.slow_ms = slow_ms  # how long a route stays shed or demoted
+        self.slow_policy = slow_policy
+        # Set by a Dispatcher with several priority classes. DEMOTE needs one to move routes to,
+        # without it routes are shed instead.
+        self.demotes = False
+        self.shed = 0  # route calls skipped while their route was shed
+        self._penalties = {}  # dict[RoutePlan, tuple[int, int]] shed or demoted routes: since, priority
+        self.worker = None  # usniffs.worker.Worker running the handlers of threaded routes
+        self.dispatcher = None  # usniffs.dispatch.Dispatcher queuing windows closed by `batch_ms`
+        self._topics = {}  # dict[bytes, str] so repeated topics reuse one str object
+        self._topic_cache_size = topic_cache_size
+        self.subscription_limit = subscription_limit  # max filters generated for one route
         self._awaitable_returns = awaitable_returns
+        self._strings = {}  # dict[str, str] so equal segments and filters of routes share one str
+        self._compiled = None  # dict[tuple[str, str], tuple] of routes compiled ahead of time
+        self._compiled_paths = None  # subscriptions compiled ahead of time, while still valid
+        self._n_loaded = 0  # routes registered from the compiled routes
 
-    def register(self, topic_route: str, callback) -> None:
+    def register(
+        self,
+        topic_route: str,
+        callback,
+        payload: str = STR,
+        decoder=None,
+        dedup: bool = True,
+        priority: int = 0,
+        timeout_ms: int = None,
+        threaded: bool = False,
+        share: str = None,
+        batch: int = 0,
+        batch_ms: int = None,
+    ) -> RoutePlan:
         """
         Add a route to the router.
 
         Args:
             topic_route (str): MQTT topic template to match.
             callback (Callable): Handler function to be called when a message is received on the matched topic.
+            payload (str): How `message` is passed to the callback, one of STR, BYTES or MEMORYVIEW.
+            decoder (str|Callable|None): Decoder applied to the payload before it is passed as `message`.
+            dedup (bool): Whether duplicates found by the duplicate window skip the route.
+            priority (int): Dispatch class of the route, higher is more urgent.
+            timeout_ms (int|None): Time budget of the handler, it is cancelled when it runs longer.
+                Only for async handlers.
+            threaded (bool): Run the handler on the worker thread. Only for plain handlers.
+            share (str|None): Subscribe as a member of this shared subscription group, so the
+                broker spreads the route's messages across every client in the group.
+            batch (int): Collect up to this many messages and call the handler once with them
+                as its only argument, `batch`.
+            batch_ms (int|None): Also call the handler this long after the first message of a
+                batch, however many have been collected (up to `batch`, 64 by default).
+
+        Returns:
+            RoutePlan: The compiled route.
+        """
+        if payload not in PAYLOAD_MODES:
+            raise Exception(f"Unknown payload mode {payload}, expected one of {PAYLOAD_MODES}")
+        callback_is_async = is_async(callback)
+        if timeout_ms and not callback_is_async:
+            raise Exception(f"Route {topic_route} has a time budget, but its handler is not async")
+        if threaded and callback_is_async:
+            raise Exception(f"Route {topic_route} is threaded, but its handler is async")
+        batched = bool(batch or batch_ms)
+        if batched and threaded:
+            raise Exception(f"Route {topic_route} cannot be both batched and threaded")
+        typecode = NUMERIC.get(decoder) if isinstance(decoder, str) else None
+        decoder, payload = resolve_decoder(decoder, payload)
+        entry = None
+        if self._compiled:
+            entry = self._compiled.get((topic_route, getattr(callback, "__name__", None)))
+        if entry is None:
+            segments, arg_map, topic_filters = self._compile(topic_route, callback, batched)
+            if share:
+                topic_filters = [share_filter(share, topic_filter) for topic_filter in topic_filters]
+            self._compiled_paths = None
+        else:
+            _, _, segments, arg_map, topic_filters = entry
+            segments = [(kind, set(value) if kind == OPTIONS else value) for kind, value in segments]
+            self._n_loaded += 1
+        segments = [
+            (kind, self._intern(value) if kind == LITERAL else value) for kind, value in segments
+        ]
+
+        plan = RoutePlan(
+            self._next_index, topic_route, callback, len(segments), arg_map, payload, decoder
+        )
+        self._next_index += 1
+        if not dedup:  # only options that differ from the class defaults are stored
+            plan.dedup = False
+        if priority:
+            plan.priority = priority
+        if timeout_ms is not None:
+            plan.timeout_ms = timeout_ms
+        if not callback_is_async:
+            plan.is_async = False
+        if threaded:
+            plan.threaded = True
+        if batched:
+            sources = tuple(self._capture_sources(topic_route, segments))
+            plan.batcher = Batcher(batch or 64, batch_ms, typecode, sources)
+        filters = []
+        for topic_filter in topic_filters:
+            topic_filter = self._intern(topic_filter)
+            filters.append(topic_filter)
+            self._filter_refs[topic_filter] = self._filter_refs.get(topic_filter, 0) + 1
+        plan.filters = tuple(filters)
+
+        self.routes.append(plan)
+        if self.match_cache is not None:
+            self.match_cache.clear()
+        if self.retained_cache is not None:
+            self.retained_cache.clear()  # the new route has not seen any retained message yet
+        if all(kind == LITERAL for kind, _ in segments):
+            self._literals[topic_route] = self._literals.get(topic_route, ()) + (plan,)
+        else:
+            self._trie.insert(segments, plan)
+            if segments[-1][0] == TAIL:
+                self._tails += 1
+            else:
+                self._depths[len(segments)] = self._depths.get(len(segments), 0) + 1
+        return plan
+
+    def _compile(self, topic_route: str, callback, batched: bool = False) -> tuple:
+        """
+        Parse a route template and its handler's signature.
+
+        Args:
+            topic_route (str): MQTT topic template to match.
+            callback (Callable): Handler of the route.
+            batched (bool): Whether the handler takes a `batch` instead of single messages.
+
+        Returns:
+            tuple[list, tuple[int], list[str]]: The trie segments, the argument map and the
+            subscription filters of the route.
         """
         route_arg_names = self._parse_route_args(topic_route)
         func_arg_names = arg_names(callback)
+        if batched and func_arg_names != ["batch"]:
+            raise Exception(
+                f"Handler of batched route {topic_route} must take only `batch`, got {func_arg_names}"
+            )
 
         _incorrect_args = [
             arg_name
@@ -35,85 +288,626 @@ class Router:
             if arg_name != "topic"
             and arg_name != "message"
             and arg_name not in route_arg_names
+            and not batched
         ]
         if _incorrect_args:
             raise Exception(
                 f"Arguments found in function definition that were not in routing template: {_incorrect_args}"
             )
 
-        topic_pattern = self._parse_topic_pattern(topic_route)
-        kwargs = {arg: "<placeholder>" for arg in func_arg_names}
-        route_dict = {
-            "topic_pattern": topic_pattern,  # str
-            "route_arg_names": route_arg_names,
-            "callback": callback,  # Callable[[*list[str]],None]
-            "kwargs": kwargs,  # dict[string,string|None]
-            "topic_route": topic_route,
-        }
-        self.routes.append(route_dict)
+        segments = self._parse_segments(topic_route)
+        for kind, _ in segments[:-1]:
+            if kind == TAIL:
+                raise Exception(f"Multi-level wildcard must be the last level of route {topic_route}")
+        sources = self._capture_sources(topic_route, segments)
+        arg_map = []
+        for arg in func_arg_names:
+            if arg == "message" or batched:  # a batch is passed in place of the message
+                arg_map.append(MESSAGE)
+            elif arg == "topic":
+                arg_map.append(TOPIC)
+            else:
+                arg_map.append(sources[route_arg_names.index(arg)])
 
-    async def route(self, topic: str, message: str) -> tuple:
+        filters = []
+        seen = set()
+        for topic_filter in self._generate_subscription_topic_paths(
+            topic_route, self.subscription_limit
+        ):
+            if topic_filter not in seen:
+                seen.add(topic_filter)
+                filters.append(topic_filter)
+        return segments, tuple(arg_map), filters
+
+    @staticmethod
+    def _capture_sources(topic_route: str, segments: list) -> list:
+        """The topic level index, or `REST - index` for a tail, of each placeholder of a route."""
+        sources = []
+        for level, part in enumerate(topic_route.split("/")):
+            if part.startswith(LV_T):
+                sources.append(REST - level if segments[level][0] == TAIL else level)
+        return sources
+
+    def export(self) -> tuple:
         """
-        Route a received message to the appropriate handler based on the topic.
+        Compiled form of every registered route, for `usniffs.compiler` to write out as a module.
+
+        Returns:
+            tuple[list[tuple], list[str]]: One (topic_route, handler name, segments, arg_map,
+            filters) entry per route, and the subscription filters of all the routes.
+        """
+        routes = []
+        for plan in self.routes:
+            segments = [
+                (kind, tuple(sorted(value)) if kind == OPTIONS else value)
+                for kind, value in self._parse_segments(plan.topic_route)
+            ]
+            routes.append(
+                (
+                    plan.topic_route,
+                    plan.callback.__name__,
+                    tuple(segments),
+                    plan.arg_map,
+                    plan.filters,
+                )
+            )
+        return routes, self.get_topic_paths()
+
+    def load(self, routes: tuple, subscriptions: tuple) -> None:
+        """
+        Use routes compiled ahead of time. Registering a route found in `routes` then skips
+        parsing its template and its handler's signature, and while exactly the compiled routes
+        are registered, `get_topic_paths` returns `subscriptions` as they are.
+
+        Args:
+            routes (tuple[tuple]): Route entries, as returned by `export`.
+            subscriptions (tuple[str]): Subscription filters, as returned by `export`.
+        """
+        self._compiled = {(entry[0], entry[1]): entry for entry in routes}
+        self._compiled_paths = list(subscriptions)
+        self._n_loaded = 0
+
+    def _intern(self, string: str) -> str:
+        interned = self._strings.get(string)
+        if interned is None:
+            interned = self._strings[string] = string
+        return interned
+
+    def unregister(self, plan: RoutePlan) -> list:
+        """
+        Remove a route from the router.
+
+        Args:
+            plan (RoutePlan): The route, as returned by `register`.
+
+        Returns:
+            list[str]: Subscription filters no other route needs any more.
+        """
+        released = self.exclusive_filters(plan)
+        self._compiled_paths = None
+        for topic_filter in plan.filters:
+            refs = self._filter_refs[topic_filter] - 1
+            if refs:
+                self._filter_refs[topic_filter] = refs
+            else:
+                del self._filter_refs[topic_filter]
+                self._strings.pop(topic_filter, None)
+
+        self.routes.remove(plan)
+        self._penalties.pop(plan, None)
+        if self.match_cache is not None:
+            self.match_cache.clear()
+        literal_plans = self._literals.get(plan.topic_route)
+        if literal_plans and plan in literal_plans:
+            literal_plans = tuple(p for p in literal_plans if p is not plan)
+            if literal_plans:
+                self._literals[plan.topic_route] = literal_plans
+            else:
+                del self._literals[plan.topic_route]
+        else:
+            segments = self._parse_segments(plan.topic_route)
+            self._trie.remove(segments, plan)
+            if segments[-1][0] == TAIL:
+                self._tails -= 1
+                return released
+            refs = self._depths[plan.n_levels] - 1
+            if refs:
+                self._depths[plan.n_levels] = refs
+            else:
+                del self._depths[plan.n_levels]
+        return released
+
+    def exclusive_filters(self, plan: RoutePlan) -> list:
+        """
+        Subscription filters of a registered route that no other route needs.
+
+        Args:
+            plan (RoutePlan): The route, as returned by `register`.
+
+        Returns:
+            list[str]: The filters, which were new when the route was the last one registered.
+        """
+        return [f for f in plan.filters if self._filter_refs.get(f) == 1]
+
+    def subscription_changes(self, subscribed: set, added=(), released=()) -> tuple:
+        """
+        Work out how to keep the subscriptions minimal after routes were added or removed, from
+        only the filters that gained their first or lost their last route.
+
+        A removed filter may have been covering filters of other routes, which were left out
+        when subscribing, so those are subscribed to in its place. An added filter is skipped if
+        a subscribed filter covers it, and replaces the subscribed filters it covers.
+
+        Args:
+            subscribed (set[str]): Filters currently subscribed to, updated in place.
+            added (list[str]): Filters no route needed before, as returned by `exclusive_filters`.
+            released (list[str]): Filters no route needs any more, as returned by `unregister`.
+
+        Returns:
+            tuple[list[str], list[str]]: Filters to subscribe to, then filters to unsubscribe from.
+        """
+        subscribe = []
+        unsubscribe = []
+        candidates = list(added)
+        dropped = [topic_filter for topic_filter in released if topic_filter in subscribed]
+        for topic_filter in dropped:
+            subscribed.remove(topic_filter)
+            unsubscribe.append(topic_filter)
+        if dropped:
+            for topic_filter in self._filter_refs:
+                if topic_filter not in subscribed and any(covers(d, topic_filter) for d in dropped):
+                    candidates.append(topic_filter)
+        for topic_filter in candidates:
+            if topic_filter in subscribed:
+                continue
+            # Only a filter with a wildcard can cover a different filter.
+            wildcards = [s for s in subscribed if "+" in s or "#" in s]
+            if any(covers(wildcard, topic_filter) for wildcard in wildcards):
+                continue
+            if "+" in topic_filter or "#" in topic_filter:
+                for covered in [s for s in subscribed if covers(topic_filter, s)]:
+                    subscribed.remove(covered)
+                    if covered in subscribe:
+                        subscribe.remove(covered)
+                    else:
+                        unsubscribe.append(covered)
+            subscribed.add(topic_filter)
+            subscribe.append(topic_filter)
+        return subscribe, unsubscribe
+
+    def match(self, topic: str) -> tuple:
+        """
+        Find the routes matching a topic.
+
+        Args:
+            topic (str): MQTT topic of the received message.
+
+        Returns:
+            tuple[list[RoutePlan], list[str]|None]: Matched routes in registration order, and the
+            topic levels when the topic had to be split to match placeholders (otherwise None).
+        """
+        cache = self.match_cache
+        if cache is not None:
+            cached = cache.get(topic)
+            if cached is not None:
+                if self.metrics:
+                    self._count_matches(cached[0])
+                return cached
+
+        matched = self._literals.get(topic, ())
+        levels = None
+        if self._tails or topic.count("/") + 1 in self._depths:
+            levels = topic.split("/")
+            trie_matched = self._trie.match(levels)
+            if trie_matched:
+                if matched:
+                    trie_matched.extend(matched)
+                if len(trie_matched) > 1:
+                    trie_matched.sort(key=_route_index)
+                matched = trie_matched
+        if cache is not None:
+            cache.put(topic, (matched, levels))
+        if self.metrics:
+            self._count_matches(matched)
+        return matched, levels
+
+    def _count_matches(self, matched: list) -> None:
+        if not matched:
+            self.unmatched += 1
+        for plan in matched:
+            plan.count(MATCHES)
+
+    def topic(self, topic) -> str:
+        """
+        Decode a received topic, reusing the str of a recently seen topic when possible. A
+        `$share/<group>/` prefix is removed, so shared messages match the underlying route.
+
+        Args:
+            topic (bytes|str): MQTT topic as received.
+
+        Returns:
+            str: The decoded topic.
+        """
+        if isinstance(topic, str):
+            return _strip_share(topic)
+        cached = self._topics.get(topic)
+        if cached is None:
+            cached = _strip_share(topic.decode())
+            if len(self._topics) < self._topic_cache_size:
+                self._topics[topic] = cached
+        return cached
+
+    def suppress(self, topic: str, message, retained: bool) -> bool:
+        """
+        Check whether a message repeats a retained payload already delivered on its topic.
+
+        Only does anything while `retained_cache` is enabled. Every message records the digest
+        of its payload under its topic, and a retained message whose digest equals the recorded
+        one, as the broker replays on every reconnection, is counted in `suppressed`.
 
         Args:
             topic (str): MQTT topic of the received message.
-            message (str): Payload of the received message.
+            message (bytes|str): Payload of the received message.
+            retained (bool): Whether the broker flagged the message as retained.
+
+        Returns:
+            bool: True if the message should not be passed to any handler.
+        """
+        cache = self.retained_cache
+        if cache is None:
+            return False
+        # MicroPython's str and bytes hashes are short, the length makes a collision much less likely.
+        digest = (len(message), hash(message))
+        if retained and cache.get(topic) == digest:
+            self.suppressed += 1
+            return True
+        cache.put(topic, digest)
+        return False
+
+    def receive(self, topic, message, retained: bool = False) -> tuple:
+        """
+        Decode a received topic and find the routes the message should be passed to, leaving out
+        suppressed retained replays and, for routes that opted in, duplicate deliveries.
+
+        Args:
+            topic (bytes|str): MQTT topic of the received message.
+            message (bytes|str): Payload of the received message.
+            retained (bool): Whether the broker flagged the message as retained.
+
+        Returns:
+            tuple[str, list[RoutePlan], list[str]|None]: The topic, and the routes and topic levels
+            as returned by `match`.
+        """
+        topic = self.topic(topic)
+        if self.suppress(topic, message, retained):
+            return topic, (), None
+        duplicate = self.duplicates is not None and self.duplicates.seen(topic, message)
+        matched, levels = self.match(topic)
+        if duplicate and matched:
+            matched = [plan for plan in matched if not plan.dedup]
+        if self._penalties and matched:
+            matched = self._penalise(matched)
+        return topic, matched, levels
+
+    def _penalise(self, matched: list) -> list:
+        """Leave out shed routes, and lift penalties that have lasted `slow_ms`."""
+        now = ticks_ms()
+        kept = []
+        for plan in matched:
+            penalty = self._penalties.get(plan)
+            if penalty is not None:
+                since, priority = penalty
+                if ticks_diff(now, since) >= self.slow_ms:
+                    del self._penalties[plan]
+                    plan.priority = priority
+                elif not self.demotes:
+                    self.shed += 1
+                    continue
+            kept.append(plan)
+        return kept
+
+    def _timed_out(self, plan: RoutePlan) -> None:
+        plan.timeouts += 1
+        plan.strikes += 1
+        if self.slow_after and plan.strikes >= self.slow_after and plan not in self._penalties:
+            plan.strikes = 0
+            self._penalties[plan] = (ticks_ms(), plan.priority)
+            if self.demotes:
+                plan.priority = 0
+            print(
+                f"Route {plan.topic_route} over its time budget {self.slow_after} times in a row, "
+                f"{DEMOTE if self.demotes else SHED} for {self.slow_ms}ms"
+            )
+
+    @staticmethod
+    def payloads(matched: list, message) -> list:
         """
+        Get the `message` value of each matched route.
+
+        The payload is decoded to a str at most once, and each decoder runs at most once per
+        payload mode, however many of the matched routes ask for it. A route whose decoder raised
+        gets DECODE_FAILED and has its `decode_errors` counted.
+
+        Args:
+            matched (list[RoutePlan]): Routes matched by the message.
+            message (bytes|str): Payload as received.
+
+        Returns:
+            list: One value per matched route, None for routes that do not take `message`.
+        """
+        text = message if isinstance(message, str) else None
+        decoded = None  # dict[tuple[Callable, str], object], created for the first decoder used
+        values = []
+        for plan in matched:
+            if not plan.wants_message:
+                values.append(None)
+                continue
+            mode = plan.payload
+            if mode == STR:
+                if text is None:
+                    text = message.decode()
+                value = text
+            else:
+                value = message.encode() if isinstance(message, str) else message
+                if mode == MEMORYVIEW:
+                    value = memoryview(value)
+            decoder = plan.decoder
+            if decoder is not None:
+                if decoded is None:
+                    decoded = {}
+                key = (decoder, mode)  # a decoder gets a different input in each payload mode
+                if key in decoded:
+                    value = decoded[key]
+                else:
+                    try:
+                        value = decoder(value)
+                    except Exception:
+                        value = DECODE_FAILED
+                    decoded[key] = value
+                if value is DECODE_FAILED:
+                    plan.decode_errors += 1
+            values.append(value)
+        return values
+
+    async def route(self, topic, message, retained: bool = False) -> tuple:
+        """
+        Route a received message to the appropriate handler based on the topic.
+
+        Args:
+            topic (bytes|str): MQTT topic of the received message.
+            message (bytes|str): Payload of the received message.
+            retained (bool): Whether the broker flagged the message as retained.
+        """
+        topic, matched, levels = self.receive(topic, message, retained)
+        if not matched:
+            return ()
+        values = self.payloads(matched, message)
         results = []
-        for route in self.routes:
-            _kwargs = {
-                "topic": topic,
-                "message": message,
-            }
-            match = route["topic_pattern"].match(topic)
-            is_same_number_of_subtopics = route["topic_route"].count(
-                "/"
-            ) == topic.count("/")
-            if match and is_same_number_of_subtopics:
-                for (
-                    n,
-                    match_value,
-                ) in enumerate(match_groups(match)):
-                    _kwargs[route["route_arg_names"][n]] = match_value
-                func = route["callback"]
-                kwargs = route["kwargs"]
-                for key in kwargs.keys():
-                    kwargs[key] = _kwargs[key]
-                result = await func(**kwargs)
-                self._awaitable_returns.trigger_awaitable_route(
-                    route["topic_route"], result
-                )
-                results.append(result)
-        return tuple(results) if results else tuple()
+        for n in range(len(matched)):
+            value = values[n]
+            if value is DECODE_FAILED:
+                continue
+            plan = matched[n]
+            if plan.batcher is not None:
+                batch = self.collect(plan, topic, value, levels)
+                if batch is DECODE_FAILED:
+                    continue
+                results.append(None if batch is None else await self.flush(plan, batch))
+            elif plan.threaded and self.worker is not None:
+                await self.worker.submit(plan, topic, value, levels)
+                results.append(None)  # the result is delivered to the awaitable return later
+            elif plan.is_async:
+                results.append(await self.call(plan, topic, value, levels))
+            else:
+                results.append(self.call_sync(plan, topic, value, levels))
+        return tuple(results)
+
+    async def call(self, plan: RoutePlan, topic: str, message, levels: list):
+        """
+        Invoke a matched route's handler and trigger its awaitable return. A handler running
+        longer than the route's `timeout_ms` is cancelled, counted in `timeouts`, and returns None
+        without triggering the awaitable return.
+
+        Args:
+            plan (RoutePlan): The matched route.
+            topic (str): MQTT topic of the received message.
+            message: Payload, as returned by `payloads`.
+            levels (list[str]|None): Topic levels, as returned by `match`.
+        """
+        if not plan.is_async:
+            return self.call_sync(plan, topic, message, levels)
+        args = self._arguments(plan, topic, message, levels)
+        handler = plan.callback(*args)
+        if plan.timeout_ms:
+            handler = asyncio.wait_for(handler, plan.timeout_ms / 1000)
+        try:
+            if not self.metrics:
+                result = await handler
+            else:
+                counters = plan.count(CALLS)
+                start = ticks_us()
+                try:
+                    result = await handler
+                except asyncio.TimeoutError:
+                    raise
+                except Exception:
+                    counters[ERRORS] += 1
+                    raise
+                finally:
+                    _count_time(counters, start)
+        except asyncio.TimeoutError:
+            self._timed_out(plan)
+            return None
+        if plan.strikes:
+            plan.strikes = 0
+        self._awaitable_returns.trigger_awaitable_route(plan.topic_route, result)
+        return result
+
+    def collect(self, plan: RoutePlan, topic: str, message, levels: list):
+        """
+        Add a message to the open window of a batched route.
+
+        Args:
+            plan (RoutePlan): The matched route, registered with `batch` or `batch_ms`.
+            topic (str): MQTT topic of the received message.
+            message: Payload, as returned by `payloads`.
+            levels (list[str]|None): Topic levels, as returned by `match`.
+
+        Returns:
+            Batch|None: The window, when the message closed it and it should be passed to `flush`,
+            or DECODE_FAILED when the payload does not fit the batch's array.
+        """
+        batcher = plan.batcher
+        sources = batcher.sources
+        if not sources:  # no placeholders, every message shares the empty tuple
+            captures = ()
+        elif len(sources) == 1 and sources[0] >= 0:  # the usual case, without a generator
+            captures = (levels[sources[0]],)
+        else:
+            captures = tuple(
+                levels[source] if source >= 0 else "/".join(levels[REST - source:])
+                for source in sources
+            )
+        try:
+            batch = batcher.add(topic, captures, message)
+        except OverflowError:  # an "int" payload outside the array's range
+            plan.decode_errors += 1
+            return DECODE_FAILED
+        if batch is None and batcher.window_ms is not None and batcher.batch._count == 1:
+            asyncio.create_task(self._close_window(plan, batcher.windows))
+        return batch
+
+    async def flush(self, plan: RoutePlan, batch):
+        """
+        Call a batched route's handler with a closed window, then reuse the window. Windows of a
+        route are handled one at a time, whether they were closed by count or by `batch_ms`.
+
+        Args:
+            plan (RoutePlan): The batched route.
+            batch (Batch): The window, as returned by `collect`.
+        """
+        async with plan.batcher.lock:
+            try:
+                if plan.is_async:
+                    return await self.call(plan, None, batch, None)
+                return self.call_sync(plan, None, batch, None)
+            finally:
+                plan.batcher.release(batch)
+
+    async def _close_window(self, plan: RoutePlan, window: int) -> None:
+        """
+        Close a window `batch_ms` after its first message, unless it was closed already. With a
+        dispatcher, the window is queued behind the route's other messages like any other.
+        """
+        batcher = plan.batcher
+        await asyncio.sleep(batcher.window_ms / 1000)
+        if batcher.windows == window and len(batcher.batch) and plan in self.routes:
+            batch = batcher.take()
+            if self.dispatcher is not None:
+                await self.dispatcher.enqueue(plan, None, batch, None)
+                return
+            try:
+                await self.flush(plan, batch)
+            except Exception as e:
+                print(f"Exception in route {plan.topic_route}: {repr(e)}")
+
+    def count_call(self, plan: RoutePlan, failed: bool, elapsed: int) -> None:
+        """Count a handler call made outside `call` and `call_sync`, while metrics are enabled."""
+        counters = plan.count(CALLS)
+        if failed:
+            counters[ERRORS] += 1
+        counters[TOTAL_US] += elapsed
+        if elapsed > counters[MAX_US]:
+            counters[MAX_US] = elapsed
+
+    def call_sync(self, plan: RoutePlan, topic: str, message, levels: list):
+        """
+        Invoke a matched route's plain (not async) handler and trigger its awaitable return,
+        without creating a coroutine. Takes the same arguments as `call`.
+        """
+        args = self._arguments(plan, topic, message, levels)
+        if not self.metrics:
+            result = plan.callback(*args)
+        else:
+            counters = plan.count(CALLS)
+            start = ticks_us()
+            try:
+                result = plan.callback(*args)
+            except Exception:
+                counters[ERRORS] += 1
+                raise
+            finally:
+                _count_time(counters, start)
+        self._awaitable_returns.trigger_awaitable_route(plan.topic_route, result)
+        return result
+
+    @staticmethod
+    def _arguments(plan: RoutePlan, topic: str, message, levels: list):
+        """Positional arguments of a route's handler, in the order of its signature."""
+        arg_map = plan.arg_map
+        if not arg_map:
+            return ()
+        args = []
+        for source in arg_map:
+            if source >= 0:
+                args.append(levels[source])
+            elif source == TOPIC:
+                args.append(topic)
+            elif source == MESSAGE:
+                args.append(message)
+            else:
+                args.append("/".join(levels[REST - source:]))
+        return args
+
+    def stats(self) -> list:
+        """
+        Snapshot of the per route counters.
 
-    def _parse_topic_pattern(self, topic_pattern: str) -> re.Pattern:
+        Returns:
+            list[dict]: One dict of counters per route, in registration order.
+        """
+        stats = []
+        for plan in self.routes:
+            counters = plan.counters or (0, 0, 0, 0, 0)
+            stats.append(
+                {
+                    "route": plan.topic_route,
+                    "matches": counters[MATCHES],
+                    "calls": counters[CALLS],
+                    "errors": counters[ERRORS],
+                    "decode_errors": plan.decode_errors,
+                    "timeouts": plan.timeouts,
+                    "total_us": counters[TOTAL_US],
+                    "max_us": counters[MAX_US],
+                }
+            )
+        return stats
+
+    @staticmethod
+    def _parse_segments(topic_pattern: str) -> list:
         """
-        Parse MQTT topic pattern and add named capture groups automatically.
+        Parse MQTT topic pattern into the per-level segments used by the topic trie.
 
         Args:
             topic_pattern (str): MQTT topic pattern.
 
         Returns:
-            re.Pattern: Compiled regular expression pattern.
+            list[tuple[int, str|set[str]|None]]: One (kind, value) pair per topic level.
         """
-        pattern_parts = []
+        segments = []
         for part in topic_pattern.split("/"):
             if LO_T in part and RO_T in part:
                 variable_string, options_string = part.split(V_D)
                 options_string = options_string[1:-1]
-                options = options_string.split(O_D)
-                options = [option for option in options if option]
-                part = f"({'|'.join(map(re_escape, options))})"
-            elif part.startswith(LV_T) and part.endswith(
-                RV_T
-            ):
-                part = f"([^/]+)"
-            elif part == "+":
-                part = "[^/]+"
-            pattern_parts.append(part)
-        pattern = "/".join(pattern_parts)
-        return re.compile(pattern)
+                options = set(option for option in options_string.split(O_D) if option)
+                segments.append((OPTIONS, options))
+            elif part == "#" or (part.startswith(LV_T) and part.endswith(T_T + RV_T)):
+                segments.append((TAIL, None))
+            elif (part.startswith(LV_T) and part.endswith(RV_T)) or part == "+":
+                segments.append((WILDCARD, None))
+            else:
+                segments.append((LITERAL, part))
+        return segments
 
     @staticmethod
     def _parse_route_args(topic_pattern: str) -> list[str]:
@@ -131,6 +925,8 @@ class Router:
             if LO_T in part and RO_T in part:
                 variable_string, options_string = part.split(V_D)
                 variables.append(variable_string[1:-1])
+            elif part.startswith(LV_T) and part.endswith(T_T + RV_T):
+                variables.append(part[1:-1 - len(T_T)])
             elif part.startswith(LV_T) and part.endswith(
                 RV_T
             ):
@@ -138,7 +934,19 @@ class Router:
         return variables
 
     @staticmethod
-    def _generate_subscription_topic_paths(topic_pattern: str) -> list[str]:
+    def _generate_subscription_topic_paths(topic_pattern: str, limit: int = None) -> list[str]:
+        """
+        Expand the option sets of a topic pattern into subscription filters.
+
+        Args:
+            topic_pattern (str): MQTT topic pattern.
+            limit (int|None): Largest number of filters to generate. While the expansion would be
+                larger, the biggest option set is subscribed to as `+` instead; the router still
+                only dispatches topics that match one of the options.
+
+        Returns:
+            list[str]: Subscription filters.
+        """
         generated_subscription_topics = []
         parts = topic_pattern.split("/")  # parts => ["foo", "bar", "<variable>:{option1,option2}", "baz"]
         variables = []
@@ -149,8 +957,13 @@ class Router:
                     parsed_options = var_options[1].strip(LO_T).strip(RO_T).strip(" ").split(O_D)  # parsed_options => "["option1","option2"]"
                     variables.append((part, parsed_options))
                 elif len(var_options) == 1:  # e.g. ["<variable>"]
-                    var = var_options[0]  # var => "<variable>"
-                    variables.append((var, ["+"]))
+                    var = var_options[0]  # var => "<variable>" or "<variable...>"
+                    variables.append((var, ["#" if var.endswith(T_T + RV_T) else "+"]))
+
+        if limit:
+            while _n_combinations(variables) > limit:
+                largest = max(range(len(variables)), key=lambda n: len(variables[n][1]))
+                variables[largest] = (variables[largest][0], ["+"])
 
         combinations = itertools_product(*[options for _, options in variables])
         for combo in combinations:
@@ -162,7 +975,38 @@ class Router:
         return generated_subscription_topics
 
     def get_topic_paths(self):
+        """
+        Subscription filters covering every route, without duplicates or filters already
+        covered by another route's filter.
+        """
+        if self._compiled_paths is not None and self._n_loaded == len(self._compiled):
+            return self._compiled_paths
         topic_paths = []
         for route in self.routes:
-            topic_paths += self._generate_subscription_topic_paths(route["topic_route"])
-        return topic_paths
+            topic_paths += route.filters
+        return minimise(topic_paths)
+
+
+def _route_index(plan: RoutePlan) -> int:
+    return plan.index
+
+
+def _strip_share(topic: str) -> str:
+    """Topic without a `$share/<group>/` prefix, for brokers that deliver shared messages with it."""
+    if topic.startswith(SHARE_PREFIX):
+        return topic.split("/", 2)[2]
+    return topic
+
+
+def _count_time(counters: list, start: int) -> None:
+    elapsed = ticks_diff(ticks_us(), start)
+    counters[TOTAL_US] += elapsed
+    if elapsed > counters[MAX_US]:
+        counters[MAX_US] = elapsed
+
+
+def _n_combinations(variables: list) -> int:
+    n = 1
+    for _, options in variables:
+        n *= len(options)
+    return n
@@ -0,0 +1,82 @@
+SHARE_PREFIX = "$share/"  # start of a shared subscription filter, `$share/<group>/<filter>`
+
+
+def share_filter(group: str, topic_filter: str) -> str:
+    """Shared subscription filter, whose messages the broker spreads across the members of `group`."""
+    return f"{SHARE_PREFIX}{group}/{topic_filter}"
+
+
+def split_share(topic_filter: str) -> tuple:
+    """
+    Split a shared subscription filter into its group and underlying filter.
+
+    Args:
+        topic_filter (str): Subscription filter, shared or not.
+
+    Returns:
+        tuple[str|None, str]: The share group, None if the filter is not shared, and the filter.
+    """
+    if not topic_filter.startswith(SHARE_PREFIX):
+        return None, topic_filter
+    _, group, underlying = topic_filter.split("/", 2)
+    return group, underlying
+
+
+def covers(general: str, specific: str) -> bool:
+    """
+    Check whether every topic matched by one subscription filter is also matched by another.
+    Shared and plain filters are delivered differently, so they only cover filters shared with
+    the same group.
+
+    Args:
+        general (str): Subscription filter that may cover `specific`.
+        specific (str): Subscription filter that may be covered.
+
+    Returns:
+        bool: True if subscribing to `specific` as well as `general` would receive nothing new.
+    """
+    general_group, general = split_share(general)
+    specific_group, specific = split_share(specific)
+    if general_group != specific_group:
+        return False
+    general_levels = general.split("/")
+    specific_levels = specific.split("/")
+    n_specific = len(specific_levels)
+    for n, level in enumerate(general_levels):
+        if level == "#":
+            return True
+        if n >= n_specific:
+            return False
+        specific_level = specific_levels[n]
+        if specific_level == "#":
+            return False
+        if level == "+":
+            continue
+        if level != specific_level or specific_level == "+":
+            return False
+    return len(general_levels) == n_specific
+
+
+def minimise(filters: list) -> list:
+    """
+    Remove duplicate subscription filters and filters covered by another filter.
+
+    Args:
+        filters (list[str]): Subscription filters, possibly overlapping.
+
+    Returns:
+        list[str]: The filters still needed, in their original order.
+    """
+    unique = []
+    seen = set()
+    for topic_filter in filters:
+        if topic_filter not in seen:
+            seen.add(topic_filter)
+            unique.append(topic_filter)
+    # Only a filter with a wildcard can cover a different filter, so only those are compared.
+    wildcards = [f for f in unique if "+" in f or "#" in f]
+    return [
+        topic_filter
+        for topic_filter in unique
+        if not any(other != topic_filter and covers(other, topic_filter) for other in wildcards)
+    ]
@@ -0,0 +1,172 @@
+LITERAL = 0   # segment must equal the stored string
+OPTIONS = 1   # segment must be one of a set of strings
+WILDCARD = 2  # any non-empty segment
+TAIL = 3      # this and every following level, including none at all (`#`)
+
+
+class _Node:
+    # Containers are only created once something is added to them, most nodes use one or two.
+    __slots__ = ("literals", "options", "option_sets", "wildcard", "routes", "tail")
+
+    def __init__(self):
+        self.literals = None     # dict[str, _Node] | None
+        self.options = None      # dict[str, tuple[_Node]] | None, children whose set holds the option
+        self.option_sets = None  # list[tuple[set[str], _Node]] | None, one child per distinct set
+        self.wildcard = None     # _Node | None
+        self.routes = None     # list of routes whose template ends at this node | None
+        self.tail = None       # list of routes whose template ends with a TAIL after this node | None
+
+    def is_empty(self) -> bool:
+        return not (self.literals or self.option_sets or self.wildcard or self.routes or self.tail)
+
+
+class TopicTrie:
+    """
+    Segment indexed trie of route templates.
+
+    Each level of the trie corresponds to one "/" separated level of a topic. Literal segments
+    are looked up in a dict, every option of an option set is indexed in a dict of the children
+    whose set holds it, and placeholders/`+` are followed unconditionally, so matching cost depends on the depth of the topic rather than on
+    the number of registered routes. Routes ending in `#` are kept on the node before it and
+    match as soon as a topic reaches that node.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+
+    def insert(self, segments: list, route) -> None:
+        """
+        Add a route to the trie.
+
+        Args:
+            segments (list[tuple[int, str|set[str]|None]]): Parsed template, one (kind, value) per level.
+            route: Opaque route object returned by `match` when a topic reaches the end of `segments`.
+        """
+        node = self._root
+        for kind, value in segments:
+            if kind == TAIL:
+                if node.tail is None:
+                    node.tail = []
+                node.tail.append(route)
+                return
+            if kind == LITERAL:
+                if node.literals is None:
+                    node.literals = {}
+                child = node.literals.get(value)
+                if child is None:
+                    child = node.literals[value] = _Node()
+            elif kind == OPTIONS:
+                if node.option_sets is None:
+                    node.option_sets = []
+                    node.options = {}
+                child = None
+                for options, option_node in node.option_sets:
+                    if options == value:
+                        child = option_node
+                        break
+                if child is None:
+                    child = _Node()
+                    node.option_sets.append((value, child))
+                    for option in value:
+                        node.options[option] = node.options.get(option, ()) + (child,)
+            else:
+                child = node.wildcard
+                if child is None:
+                    child = node.wildcard = _Node()
+            node = child
+        if node.routes is None:
+            node.routes = []
+        node.routes.append(route)
+
+    def remove(self, segments: list, route) -> None:
+        """
+        Remove a route from the trie, pruning nodes no other route uses.
+
+        Args:
+            segments (list[tuple[int, str|set[str]|None]]): Parsed template the route was inserted with.
+            route: The route object passed to `insert`.
+        """
+        path = []  # (parent, kind, key) for each level walked
+        node = self._root
+        routes_attribute = "routes"
+        for kind, value in segments:
+            if kind == TAIL:
+                routes_attribute = "tail"
+                break
+            if kind == LITERAL:
+                child = node.literals.get(value) if node.literals else None
+                key = value
+            elif kind == OPTIONS:
+                child = None
+                for key, (options, option_node) in enumerate(node.option_sets or ()):
+                    if options == value:
+                        child = option_node
+                        break
+            else:
+                child = node.wildcard
+                key = None
+            if child is None:
+                return
+            path.append((node, kind, key))
+            node = child
+        routes = getattr(node, routes_attribute)
+        if not routes or route not in routes:
+            return
+        routes.remove(route)
+        if not routes:
+            setattr(node, routes_attribute, None)
+
+        while path and node.is_empty():
+            parent, kind, key = path.pop()
+            if kind == LITERAL:
+                del parent.literals[key]
+                if not parent.literals:
+                    parent.literals = None
+            elif kind == OPTIONS:
+                options, child = parent.option_sets.pop(key)
+                for option in options:
+                    children = tuple(c for c in parent.options[option] if c is not child)
+                    if children:
+                        parent.options[option] = children
+                    else:
+                        del parent.options[option]
+                if not parent.option_sets:
+                    parent.option_sets = None
+                    parent.options = None
+            else:
+                parent.wildcard = None
+            node = parent
+
+    def match(self, levels: list) -> list:
+        """
+        Find every route whose template matches the topic levels.
+
+        Args:
+            levels (list[str]): Topic split on "/".
+
+        Returns:
+            list: Matched routes, in no particular order.
+        """
+        matches = []
+        self._match(self._root, levels, 0, len(levels), matches)
+        return matches
+
+    def _match(self, node: _Node, levels: list, depth: int, n_levels: int, matches: list) -> None:
+        if node.tail is not None:
+            matches.extend(node.tail)
+        if depth == n_levels:
+            if node.routes:
+                matches.extend(node.routes)
+            return
+        level = levels[depth]
+        if node.literals is not None:
+            child = node.literals.get(level)
+            if child is not None:
+                self._match(child, levels, depth + 1, n_levels, matches)
+        if node.options is not None:
+            children = node.options.get(level)
+            if children is not None:
+                for child in children:
+                    self._match(child, levels, depth + 1, n_levels, matches)
+        if node.wildcard is not None and level:
+            self._match(node.wildcard, levels, depth + 1, n_levels, matches)
@@ -1,7 +1,27 @@
 import struct
 import re
-import uctypes
 import sys
+import time
+
+try:
+    import uctypes
+except ImportError:  # CPython, for running tools and benchmarks off device
+    uctypes = None
+
+
+if hasattr(time, "ticks_ms"):
+    ticks_ms = time.ticks_ms
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+else:  # CPython, for running tools and benchmarks off device
+    def ticks_ms() -> int:
+        return time.monotonic_ns() // 1000000
+
+    def ticks_us() -> int:
+        return time.monotonic_ns() // 1000
+
+    def ticks_diff(end: int, start: int) -> int:
+        return end - start
 
 
 async def _async_func():
@@ -21,6 +41,11 @@ def arg_names(fun) -> list:
     Due to lack of inspect that can check signature, we must dive into the bytecode
     to extract the function arguments. Written by @felixdoerre1 in the micropython discord.
     """
+    if uctypes is None:
+        is_bound_method = hasattr(fun, "__func__")
+        code = (fun.__func__ if is_bound_method else fun).__code__
+        return list(code.co_varnames[1 if is_bound_method else 0:code.co_argcount])
+
     ptr = len(struct.pack("O", fun))
     ptr_type = uctypes.UINT32 if ptr == 4 else uctypes.UINT64
     addr = struct.unpack("P", struct.pack("O", fun))[0]
@@ -88,6 +113,35 @@ def arg_names(fun) -> list:
     ][index_start:]
 
 
+CO_COROUTINE = 0x80  # CPython code flag of `async def` functions
+
+
+def is_async(fun) -> bool:
+    """
+    Check whether calling a function returns a coroutine to await rather than its result.
+
+    Args:
+        fun (Callable): Function, bound method or closure.
+
+    Returns:
+        bool: True for async functions, and bound methods and closures of them.
+    """
+    if uctypes is None:
+        code = getattr(fun, "__func__", fun).__code__
+        return bool(code.co_flags & CO_COROUTINE)
+
+    def closure(x):
+        nonlocal fun
+    if type(fun) == type(closure) or type(fun) == type(_FooClass().bound_method):
+        # The wrapped function is the first field after the type, for closures and bound methods.
+        ptr = len(struct.pack("O", fun))
+        ptr_type = uctypes.UINT32 if ptr == 4 else uctypes.UINT64
+        addr = struct.unpack("P", struct.pack("O", fun))[0]
+        wrapped = uctypes.struct(addr, {"fun": (ptr_type | (1 * ptr))}, uctypes.NATIVE)
+        return is_async(struct.unpack("O", struct.pack("P", wrapped.fun))[0])
+    return type(fun) == type(_async_func)
+
+
 def re_escape(pattern):
     # Replacement minimal re.escape for ure compatibility
     return re.sub(r"([\^\$\.\|\?\*\+\(\)\[\\])", r"\\\1", pattern)
@@ -0,0 +1,153 @@
+import asyncio
+import time
+import _thread
+
+from usniffs.utils import ticks_us, ticks_diff
+
+
+_EMPTY = object()  # returned by `_Ring.get` when there is nothing to take
+
+
+class _Ring:
+    """
+    Fixed capacity single producer, single consumer ring.
+
+    The producer only writes `_tail` and the consumer only writes `_head`, each after it has
+    written or read the slot, so one thread can put while the other gets without a lock.
+    """
+
+    def __init__(self, capacity: int):
+        self._items = [None] * capacity
+        self._capacity = capacity
+        self._head = 0  # next slot to get, moved by the consumer
+        self._tail = 0  # next slot to put, moved by the producer
+
+    def __len__(self) -> int:
+        return (self._tail - self._head) % (2 * self._capacity)
+
+    def put(self, item) -> bool:
+        tail = self._tail
+        if (tail - self._head) % (2 * self._capacity) == self._capacity:
+            return False
+        self._items[tail % self._capacity] = item
+        self._tail = (tail + 1) % (2 * self._capacity)
+        return True
+
+    def get(self):
+        head = self._head
+        if head == self._tail:
+            return _EMPTY
+        slot = head % self._capacity
+        item = self._items[slot]
+        self._items[slot] = None
+        self._head = (head + 1) % (2 * self._capacity)
+        return item
+
+
+class Worker:
+    """
+    Runs the handlers of routes registered with `threaded=True` on a second thread, which on
+    multicore ports such as the RP2040 runs on the other core.
+
+    Messages are handed to the thread through a preallocated ring of `capacity` slots, and results
+    come back through another one. The thread sleeps on a lock while it has nothing to do. Results
+    are passed to the routes' awaitable returns on the asyncio loop, woken by a ThreadSafeFlag
+    where the port has one and otherwise by polling every `poll_ms`.
+    """
+
+    def __init__(self, router, capacity: int = 16, poll_ms: int = 5):
+        if capacity < 1:
+            raise Exception(f"Worker capacity must be 1 or greater, got {capacity}")
+        self.router = router
+        self.poll_ms = poll_ms
+        self.submitted = 0  # messages handed to the thread
+        self.delivered = 0  # results passed back to the awaitable returns
+        self._inbox = _Ring(capacity)  # (plan, topic, message, levels), loop -> thread
+        self._outbox = _Ring(capacity)  # (plan, result, failed, elapsed_us), thread -> loop
+        self._wake = _thread.allocate_lock()  # held while the thread has nothing to do
+        flag = getattr(asyncio, "ThreadSafeFlag", None)
+        self._done = flag() if flag else None
+        self._running = False
+
+    def start(self) -> None:
+        """Start the thread, and the task that delivers its results."""
+        if self._running:
+            return
+        self._running = True
+        self._wake.acquire()
+        _thread.start_new_thread(self._run, ())
+        asyncio.create_task(self._results())
+
+    def stop(self) -> None:
+        """Stop the thread once it has handled the messages already submitted."""
+        self._running = False
+        self._signal()
+        if self._done is not None:
+            self._done.set()
+
+    async def submit(self, plan, topic: str, message, levels: list) -> None:
+        """
+        Hand a message to the thread, waiting while the ring is full.
+
+        Args:
+            plan (RoutePlan): The matched route.
+            topic (str): MQTT topic of the received message.
+            message: Payload, as returned by `Router.payloads`.
+            levels (list[str]|None): Topic levels, as returned by `Router.match`.
+        """
+        while not self._inbox.put((plan, topic, message, levels)):
+            self._signal()
+            await asyncio.sleep(0)  # let the results task make room
+        self.submitted += 1
+        self._signal()
+
+    def _signal(self) -> None:
+        if self._wake.locked():
+            self._wake.release()
+
+    def _run(self) -> None:
+        """Body of the worker thread."""
+        router = self.router
+        inbox = self._inbox
+        outbox = self._outbox
+        while self._running or len(inbox):
+            item = inbox.get()
+            if item is _EMPTY:
+                self._wake.acquire()  # until `submit` or `stop` releases it
+                continue
+            plan, topic, message, levels = item
+            start = ticks_us()
+            try:
+                result = plan.callback(*router._arguments(plan, topic, message, levels))
+                failed = False
+            except Exception as e:
+                print(f"Exception in route {plan.topic_route}: {repr(e)}")
+                result = None
+                failed = True
+            item = (plan, result, failed, ticks_diff(ticks_us(), start))
+            while not outbox.put(item):  # the loop has fallen behind, give it time to catch up
+                if self._done is not None:
+                    self._done.set()
+                time.sleep(self.poll_ms / 1000)
+            if self._done is not None:
+                self._done.set()
+
+    async def _results(self) -> None:
+        """Deliver results of the thread's handlers to the routes' awaitable returns."""
+        router = self.router
+        while self._running or len(self._outbox):
+            if self._done is not None:
+                await self._done.wait()
+            elif self.delivered == self.submitted:
+                await asyncio.sleep(self.poll_ms / 1000)
+            else:
+                await asyncio.sleep(0)  # results are due, check again on the next turn of the loop
+            item = self._outbox.get()
+            while item is not _EMPTY:
+                self.delivered += 1
+                plan, result, failed, elapsed = item
+                if router.metrics:
+                    router.count_call(plan, failed, elapsed)
+                if not failed:
+                    router._awaitable_returns.trigger_awaitable_route(plan.topic_route, result)
+                item = self._outbox.get()